@@ -0,0 +1,397 @@
+import tensorflow as tf
+import numpy as np
+import time
+import os
+import argparse
+from data_loader_direct import DataLoader, DATA_FEATURES, define_loader_flags
+import record_io
+import memmap_dataset
+from shm_producer import producer_dataset, flag_values
+
+#==================================
+# Input pipeline throughput benchmark
+#==================================
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+flags = tf.app.flags
+flags.DEFINE_string("dataset_dir", "/home/z003xr2y/data/data/tfrecords_hr_filldepth/", "Dataset directory")
+flags.DEFINE_integer("batch_size", 5, "The size of of a sample batch")
+flags.DEFINE_integer("num_batches", 50, "Number of timed batches per pipeline")
+flags.DEFINE_integer("warmup_batches", 5, "Number of untimed batches per pipeline")
+flags.DEFINE_boolean("data_aug", False, "Data augment")
+flags.DEFINE_string("mode", "parsing", "parsing: per-example vs batched parsing, codec: NONE vs ZLIB vs GZIP records, "
+                    "stages: per-stage breakdown, loader: inputs and inputs_test, backends: tfrecords vs memmap")
+flags.DEFINE_string("stages_off", "", "Stages turned off in an extra stages run, comma separated: parse normalize shuffle augment batch")
+flags.DEFINE_string("memmap_dir", "None", "Memmap dataset of the same frames, for --mode=backends")
+flags.DEFINE_string("png_dir", "None", "PNG capture folder with train.txt of the same frames, for --mode=backends")
+flags.DEFINE_string("codec_dir", "/tmp/codec_benchmark/", "Scratch directory for the re-encoded records of the codec benchmark")
+flags.DEFINE_integer("codec_records", 200, "Number of records re-encoded with every codec")
+# Loader options, same meaning as in main.py
+flags.DEFINE_integer("img_height", 480, "Image height")
+flags.DEFINE_integer("img_width", 640, "Image width")
+define_loader_flags(flags)
+flags.DEFINE_string("inputs", "all", "all IR_depth depth_color IR_color IR color depth")
+flags.DEFINE_string("model", "lastdecode", "lastdecode sinlge")
+flags.DEFINE_boolean("evaluation", False, "Decode every feature")
+flags.DEFINE_boolean("with_seg", False, "with seg")
+flags.DEFINE_boolean("with_pose", False, "with pose estimation")
+flags.DEFINE_boolean("with_dist", False, "with distance estimation")
+flags.DEFINE_boolean("with_dom", False, "with domain transform")
+flags.DEFINE_boolean("with_vis", False, "with visibility loss")
+flags.DEFINE_boolean("proj_img", False, "if False, dont project image")
+flags.DEFINE_boolean("with_H", False, "with homography estimation")
+flags.DEFINE_boolean("with_DH", False, "with homography estimation")
+flags.DEFINE_boolean("with_hm", True, "with homography estimation")
+flags.DEFINE_boolean("with_lmcoord", False, "with homography estimation")
+flags.DEFINE_boolean("with_coordconv", False, "with homography estimation")
+opt = flags.FLAGS
+
+
+def time_pipeline(sess, dataset, num_batches, warmup_batches):
+    '''
+    Pull batches from a dataset (or the get_next() tensors of one, as
+    returned by inputs_test) and return the wall time of each timed batch
+    '''
+    if isinstance(dataset, tf.data.Dataset):
+        next_batch = dataset.make_one_shot_iterator().get_next()
+    else:
+        next_batch = dataset
+    for _ in range(warmup_batches):
+        sess.run(next_batch)
+    durations = []
+    try:
+        for _ in range(num_batches):
+            start_time = time.time()
+            sess.run(next_batch)
+            durations.append(time.time() - start_time)
+    except tf.errors.OutOfRangeError:
+        pass
+    return np.array(durations)
+
+
+def report(name, durations, batch_size, bytes_per_example=None):
+    if len(durations) == 0:
+        print("%-20s no batches" % name)
+        return
+    total = durations.sum()
+    examples = len(durations)*batch_size
+    if bytes_per_example is None:
+        throughput = ""
+    else:
+        throughput = "  %8.2f MB/s" % (examples*bytes_per_example/total/1e6)
+    print("%-20s %8.2f examples/s%s  p50 %.3f s  p99 %.3f s  (%d batches)" % (
+        name,
+        examples/total,
+        throughput,
+        np.percentile(durations, 50),
+        np.percentile(durations, 99),
+        len(durations)))
+
+
+def run_pipelines(pipelines):
+    '''
+    Time a list of (name, dataset, examples per batch, bytes per example)
+    '''
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    with tf.Session(config=config) as sess:
+        for name, dataset, examples, bytes_per_example in pipelines:
+            durations = time_pipeline(sess, dataset, opt.num_batches, opt.warmup_batches)
+            report(name, durations, examples, bytes_per_example)
+
+
+def record_bytes_per_example(dataset_dir):
+    '''
+    Average stored size of a record, from the manifest or the first file
+    '''
+    manifest = record_io.load_manifest(dataset_dir)
+    if manifest is not None and manifest['num_records'] > 0:
+        return sum([shard['bytes'] for shard in manifest['shards']])/manifest['num_records']
+    filenames = record_io.dataset_files(dataset_dir)
+    _, compression = record_io.detect_record_format(dataset_dir, filenames)
+    count = 0
+    for _ in tf.python_io.tf_record_iterator(filenames[0], record_io.record_options(compression)):
+        count += 1
+    return os.path.getsize(filenames[0])/max(count, 1)
+
+
+def memmap_bytes_per_example(loader, needed):
+    '''
+    Bytes a memmap example reads for the decoded features
+    '''
+    source = memmap_dataset.MemmapDataset(loader.dataset_dir)
+    keys = set([DATA_FEATURES[key] for key in needed])
+    return sum([source.dtype(key).itemsize*int(np.prod(source.shape(key))) for key in keys])
+
+
+def png_bytes_per_example(loader, needed, num_files=100):
+    '''
+    Mean PNG bytes of the modalities in needed, from the first num_files frames
+    '''
+    paths = loader.read_labeled_image_list(loader.split)
+    total = 0
+    for key in needed:
+        files = paths[key][:num_files]
+        total += sum([os.path.getsize(path) for path in files])/max(len(files), 1)
+    return total
+
+
+def bytes_per_example(loader):
+    if loader.is_png_dataset():
+        return png_bytes_per_example(loader, loader.required_features())
+    if memmap_dataset.is_memmap_dataset(loader.dataset_dir):
+        # Memmap datasets hold coordinates, the heatmaps are always rendered
+        return memmap_bytes_per_example(loader, loader.decoded_features(True))
+    return record_bytes_per_example(loader.dataset_dir)
+
+
+def compare_parsing(opt):
+    '''
+    Per-example parsing (inputs) against batch-first parsing (inputs_batched)
+    on the same records
+    '''
+    imageloader = DataLoader(opt.dataset_dir,
+                             opt.batch_size,
+                             opt.img_height,
+                             opt.img_width,
+                             'train',
+                             opt)
+    nbytes = record_bytes_per_example(opt.dataset_dir)
+    pipelines = [
+        ("per_example", imageloader.inputs(opt.batch_size, None, opt.data_aug), opt.batch_size, nbytes),
+        ("batched", imageloader.inputs_batched(opt.batch_size, None), opt.batch_size, nbytes),
+    ]
+    run_pipelines(pipelines)
+
+
+def write_codec_files(opt, filenames, compression):
+    '''
+    Re-encode the first --codec_records records with every codec, each
+    record written to every codec as it is read (a v1 record is ~40MB).
+    Returns {codec: (filename, number of records)}
+    '''
+    if not os.path.exists(opt.codec_dir):
+        os.makedirs(opt.codec_dir)
+    outnames = dict([(codec, os.path.join(opt.codec_dir, codec.lower()+'.tfrecords')) for codec in record_io.COMPRESSION_TYPES])
+    writers = dict([(codec, tf.python_io.TFRecordWriter(outnames[codec], record_io.record_options(codec)))
+                    for codec in record_io.COMPRESSION_TYPES])
+    count = 0
+    try:
+        for filename in filenames:
+            for serialized in tf.python_io.tf_record_iterator(filename, record_io.record_options(compression)):
+                for writer in writers.values():
+                    writer.write(serialized)
+                count += 1
+                if count >= opt.codec_records:
+                    break
+            if count >= opt.codec_records:
+                break
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return dict([(codec, (outnames[codec], count)) for codec in record_io.COMPRESSION_TYPES])
+
+
+def compare_codecs(opt):
+    '''
+    Read and decode the same records stored with every codec. Bytes/s is
+    measured on the file size, i.e. what the storage has to deliver.
+    '''
+    imageloader = DataLoader(opt.dataset_dir,
+                             opt.batch_size,
+                             opt.img_height,
+                             opt.img_width,
+                             'train',
+                             opt)
+    filenames = record_io.dataset_files(opt.dataset_dir)
+    version, compression = record_io.detect_record_format(opt.dataset_dir, filenames)
+    codec_files = write_codec_files(opt, filenames, compression)
+
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    for codec in record_io.COMPRESSION_TYPES:
+        filename, num_records = codec_files[codec]
+        # Warm up the page cache so every codec reads from memory
+        with open(filename, 'rb') as f:
+            f.read()
+        with tf.Graph().as_default():
+            dataset = imageloader.record_dataset([filename], 1, codec, shuffle=False)
+            dataset = dataset.map(lambda serialized: imageloader.decode_record(serialized, version),
+                                  num_parallel_calls=8)
+            dataset = dataset.batch(opt.batch_size)
+            with tf.Session(config=config) as sess:
+                start_time = time.time()
+                durations = time_pipeline(sess, dataset, num_records, 0)
+                total = time.time() - start_time
+        size = os.path.getsize(filename)
+        print("%-6s %10.1f MB  %8.2f MB/s  %8.2f examples/s  p50 %.3f s  p99 %.3f s" % (
+            codec,
+            size/1e6,
+            size/1e6/total,
+            num_records/total,
+            np.percentile(durations, 50),
+            np.percentile(durations, 99)))
+
+
+#==================================
+# Per-stage breakdown
+#==================================
+STAGES = ['parse', 'normalize', 'shuffle', 'augment', 'batch']
+
+
+def stage_pipeline(loader, stages):
+    '''
+    The inputs() pipeline of tfrecords with only the stages in stages:
+    read, parse (raw byte features), normalize (decode_record and heatmap
+    rendering), shuffle, augment (data_augmentation2), batch. A stage that
+    needs a disabled one is skipped as well.
+    Returns:
+        (dataset, examples per element)
+    '''
+    filenames = loader.record_files()
+    version, compression = record_io.detect_record_format(loader.dataset_dir, filenames)
+    needed = loader.required_features()
+    render_hm = version == record_io.RECORD_V2 or opt.render_hm
+    keys = sorted(set([DATA_FEATURES[key] for key in loader.decoded_features(render_hm)]))
+
+    def parse(serialized):
+        return tf.parse_single_example(serialized, features=record_io.record_features(version, keys))
+
+    def normalize(serialized):
+        data_dict = loader.decode_record(serialized, version, rescale=not opt.roi_crop)
+        # ROI crops are decoded at the record resolution, not rendered here
+        if 'points2D' in needed and 'points2D' not in data_dict and not opt.roi_crop:
+            data_dict['points2D'] = loader.render_heatmaps(data_dict['pixel_coords'],
+                                                           data_dict['visibility'],
+                                                           loader.heatmap_sigma(0),
+                                                           loader.image_height,
+                                                           loader.image_width)
+        return data_dict
+
+    def augment(data_dict):
+        if opt.roi_crop:
+            return loader.roi_crop(data_dict, loader.image_height, loader.image_width, True)
+        return loader.data_augmentation2(data_dict, loader.image_height, loader.image_width)
+
+    dataset = loader.record_dataset(filenames, None, compression)
+    if 'parse' in stages and 'normalize' in stages:
+        dataset = dataset.map(normalize, num_parallel_calls=8)
+    elif 'parse' in stages:
+        dataset = dataset.map(parse, num_parallel_calls=8)
+    if 'shuffle' in stages:
+        dataset = dataset.shuffle(100)
+    if 'parse' in stages and 'normalize' in stages and 'augment' in stages:
+        dataset = dataset.map(augment, num_parallel_calls=8)
+    if 'batch' in stages:
+        return dataset.batch(opt.batch_size), opt.batch_size
+    return dataset, 1
+
+
+def compare_stages(opt):
+    '''
+    The full pipeline, then the same pipeline with one stage turned off at
+    a time; the difference is the cost of that stage
+    '''
+    imageloader = DataLoader(opt.dataset_dir,
+                             opt.batch_size,
+                             opt.img_height,
+                             opt.img_width,
+                             'train',
+                             opt)
+    nbytes = record_bytes_per_example(opt.dataset_dir)
+    configs = [("all", STAGES), ("read_only", [])]
+    for stage in STAGES:
+        configs.append(("no_"+stage, [s for s in STAGES if s != stage]))
+    if opt.stages_off != "":
+        off = opt.stages_off.split(',')
+        configs.append(("no_"+"_".join(off), [s for s in STAGES if s not in off]))
+
+    pipelines = []
+    for name, stages in configs:
+        dataset, examples = stage_pipeline(imageloader, stages)
+        pipelines.append((name, dataset, examples, nbytes))
+    run_pipelines(pipelines)
+
+
+def compare_loader(opt):
+    '''
+    DataLoader.inputs and inputs_test as used for training, and inputs
+    through the producer processes with --num_producers
+    '''
+    imageloader = DataLoader(opt.dataset_dir,
+                             opt.batch_size,
+                             opt.img_height,
+                             opt.img_width,
+                             'train',
+                             opt)
+    nbytes = bytes_per_example(imageloader)
+    pipelines = [
+        ("inputs", imageloader.inputs(opt.batch_size, None, opt.data_aug), opt.batch_size, nbytes),
+        ("inputs_test", imageloader.inputs_test(opt.batch_size, None), opt.batch_size, nbytes),
+    ]
+    if opt.num_producers > 0:
+        pipelines.append(("producers", producer_dataset(opt.dataset_dir,
+                                                        opt,
+                                                        opt.batch_size,
+                                                        None,
+                                                        opt.data_aug,
+                                                        num_workers=opt.num_producers,
+                                                        num_slots=opt.producer_slots),
+                          opt.batch_size, nbytes))
+    run_pipelines(pipelines)
+
+
+# Flags that make the loader decode labels, PNG folders have none of them
+LABEL_FLAGS = ['evaluation', 'with_hm', 'with_lmcoord', 'with_coordconv', 'with_4pcoordconv', 'roi_crop', 'with_seg',
+               'with_vis', 'with_dist', 'with_pose', 'with_H', 'with_DH', 'pretrain_pose', 'proj_img', 'with_dom']
+
+
+def compare_backends(opt):
+    '''
+    DataLoader.inputs over the same frames stored as tfrecords and as a
+    memmap dataset and PNG folders. With PNG folders every backend decodes
+    the network inputs only, the folders hold no landmark labels.
+    '''
+    backends = [("tfrecords", opt.dataset_dir)]
+    if opt.memmap_dir != "None":
+        backends.append(("memmap", opt.memmap_dir))
+    if opt.png_dir != "None":
+        backends.append(("png", opt.png_dir))
+        values = flag_values(opt)
+        for key in LABEL_FLAGS:
+            values[key] = False
+        if values['model'] in ["multiscale", "hourglass"]:
+            # Their heatmap heads need points2D
+            values['model'] = "single"
+        opt = argparse.Namespace(**values)
+        print("PNG folders have no labels, comparing the network inputs (--inputs=%s) only" % opt.inputs)
+
+    pipelines = []
+    for name, dataset_dir in backends:
+        imageloader = DataLoader(dataset_dir,
+                                 opt.batch_size,
+                                 opt.img_height,
+                                 opt.img_width,
+                                 'train',
+                                 opt)
+        pipelines.append((name,
+                          imageloader.inputs(opt.batch_size, None, opt.data_aug),
+                          opt.batch_size,
+                          bytes_per_example(imageloader)))
+    run_pipelines(pipelines)
+
+
+if __name__ == "__main__":
+    # inputs() itself dispatches on --batch_parse, keep it on the per-example path
+    opt.batch_parse = False
+    if opt.mode == "codec":
+        compare_codecs(opt)
+    elif opt.mode == "stages":
+        compare_stages(opt)
+    elif opt.mode == "loader":
+        compare_loader(opt)
+    elif opt.mode == "backends":
+        compare_backends(opt)
+    else:
+        compare_parsing(opt)
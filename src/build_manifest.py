@@ -0,0 +1,226 @@
+import os
+import re
+import json
+import hashlib
+import multiprocessing
+import time
+
+#==================================
+# Manifest of a capture tree
+#==================================
+# Every frame of a capture folder is a <prefix>color.png with the files
+#   <prefix>depth1.png, <prefix>ir.png, <prefix>depth0.png,
+#   <prefix>annotation.json (pose, homography, intrinsics, landmarks), ...
+#   <dir>/color/<name>color.png.color.png
+#   <dir>/mask/<name>color.png.landmark_filtered.png
+# The manifest records size, mtime and sha1 of every file of every frame.
+# Directories are scanned in parallel and a re-run only hashes the files
+# whose size or mtime changed. The split of a frame is drawn from its
+# sequence (directory), so the splits never share a sequence and do not
+# move when frames are added.
+
+MANIFEST_NAME = 'frames.json'
+SPLITS = ['train', 'valid', 'test']
+
+# Folders holding derived images of the frames of their parent folder
+DERIVED_DIRS = ['color', 'mask']
+
+
+def frame_files(prefix):
+    '''
+    {data_dict key: path} of the files of the frame prefix
+    '''
+    basepath, name = os.path.split(prefix)
+    return {'image': os.path.join(basepath, 'color', name+'color.png.color.png'),
+            'depth': prefix+'depth1.png',
+            'IR': prefix+'ir.png',
+            'label': os.path.join(basepath, 'mask', name+'color.png.landmark_filtered.png'),
+            'depth0': prefix+'depth0.png',
+            'annotation': prefix+'annotation.json'}
+
+
+def frame_sort_key(prefix):
+    '''
+    Sort key of a frame prefix comparing its numbers as numbers, so
+    unpadded frame numbers stay in capture order
+    '''
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', prefix)]
+
+
+def owner_stem(name, stems):
+    '''
+    Stem of the frame a file name belongs to: the longest stem it starts
+    with that is not continued by another digit (0000001 does not own
+    00000010_depth1.png), None if there is none
+    '''
+    for end in range(len(name), 0, -1):
+        stem = name[:end]
+        if stem in stems and not (stem[-1].isdigit() and name[end:end+1].isdigit()):
+            return stem
+    return None
+
+
+def file_hash(filename, block_bytes=1<<20):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(block_bytes)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def capture_dirs(root):
+    '''
+    Sorted capture folders below root, without the derived image folders
+    '''
+    dirs = []
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames[:] = sorted([d for d in dirnames if d not in DERIVED_DIRS])
+        dirs.append(dirpath)
+    return sorted(dirs)
+
+
+def scan_directory(args):
+    '''
+    Frames of one capture folder.
+    Args:
+        args: (root, directory, {relative path: entry} of the previous manifest)
+    Returns:
+        (directory, {frame prefix relative to root: {relative path: entry}},
+         number of hashed files)
+    '''
+    root, directory, previous = args
+    names = sorted(os.listdir(directory))
+    stems = set([name[:-len('color.png')] for name in names
+                 if name.endswith('color.png') and os.path.isfile(os.path.join(directory, name))])
+    # Files of every frame
+    stem_names = dict([(stem, []) for stem in stems])
+    for name in names:
+        stem = owner_stem(name, stems)
+        if stem is not None:
+            stem_names[stem].append(name)
+    frames = {}
+    hashed = 0
+    for stem in sorted(stems):
+        paths = [os.path.join(directory, other) for other in stem_names[stem]]
+        for key in DERIVED_DIRS:
+            path = frame_files(os.path.join(directory, stem))['image' if key == 'color' else 'label']
+            if os.path.exists(path):
+                paths.append(path)
+
+        files = {}
+        for path in paths:
+            if not os.path.isfile(path):
+                continue
+            relative = os.path.relpath(path, root)
+            stat = os.stat(path)
+            entry = previous.get(relative)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': file_hash(path)}
+                hashed += 1
+            files[relative] = entry
+        frames[os.path.relpath(os.path.join(directory, stem), root)] = files
+    return directory, frames, hashed
+
+
+def frame_split(sequence, seed, valid_fraction, test_fraction):
+    '''
+    Split of a sequence, fixed by the hash of (seed, sequence)
+    '''
+    digest = hashlib.sha1(('%d/%s' % (seed, sequence)).encode('utf-8')).hexdigest()
+    u = int(digest[:8], 16)/float(1<<32)
+    if u < test_fraction:
+        return 'test'
+    if u < test_fraction+valid_fraction:
+        return 'valid'
+    return 'train'
+
+
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def build_manifest(root, output_dir, num_workers=8, seed=0, valid_fraction=0.1, test_fraction=0.1):
+    '''
+    Scan root and write the manifest and <split>.txt frame lists to output_dir.
+    Unchanged files of a previous manifest in output_dir are not hashed again.
+    '''
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    root = os.path.abspath(root)
+
+    manifest = load_manifest(output_dir)
+    if manifest is None or manifest['root'] != root:
+        manifest = {'frames': {}}
+    # Previous file entries, by directory of the frame
+    previous = {}
+    for prefix, files in manifest['frames'].items():
+        directory = os.path.join(root, os.path.dirname(prefix))
+        previous.setdefault(directory, {}).update(files)
+
+    start = time.time()
+    dirs = capture_dirs(root)
+    frames = {}
+    hashed = 0
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        jobs = [(root, directory, previous.get(directory, {})) for directory in dirs]
+        for i, (directory, dir_frames, dir_hashed) in enumerate(pool.imap_unordered(scan_directory, jobs)):
+            frames.update(dir_frames)
+            hashed += dir_hashed
+            if (i+1) % 100 == 0:
+                print("Scanned %d/%d directories (%d frames, %d files hashed)" % (i+1, len(dirs), len(frames), hashed))
+    finally:
+        pool.close()
+        pool.join()
+
+    splits = dict([(split, []) for split in SPLITS])
+    for prefix in sorted(frames.keys()):
+        split = frame_split(os.path.dirname(prefix), seed, valid_fraction, test_fraction)
+        splits[split].append(prefix)
+
+    manifest = {'root': root,
+                'seed': seed,
+                'valid_fraction': valid_fraction,
+                'test_fraction': test_fraction,
+                'num_frames': len(frames),
+                'splits': splits,
+                'frames': frames}
+    # Written next to the old manifest and renamed, a killed run keeps the old one
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path+'.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(path+'.tmp', path)
+
+    # Frame lists in the format of gen_train.py: absolute prefixes, one per line
+    for split in SPLITS:
+        with open(os.path.join(output_dir, split+'.txt'), 'w') as f:
+            for prefix in splits[split]:
+                f.write(os.path.join(root, prefix)+'\n')
+
+    print("%d frames (%s) in %.1fs, %d files hashed" % (
+        len(frames),
+        ", ".join(["%s %d" % (split, len(splits[split])) for split in SPLITS]),
+        time.time()-start,
+        hashed))
+    return manifest
+
+
+if __name__ == "__main__":
+    import tensorflow as tf
+    flags = tf.app.flags
+    flags.DEFINE_string("root", "/home/z003xr2y/data/tset/", "Root of the capture tree")
+    flags.DEFINE_string("output_dir", "/home/z003xr2y/data/tset/", "Directory for the manifest and split files")
+    flags.DEFINE_integer("num_workers", 8, "Number of scanning processes")
+    flags.DEFINE_integer("seed", 0, "Seed of the sequence split")
+    flags.DEFINE_float("valid_fraction", 0.1, "Fraction of the sequences in valid")
+    flags.DEFINE_float("test_fraction", 0.1, "Fraction of the sequences in test")
+    opt = flags.FLAGS
+
+    build_manifest(opt.root, opt.output_dir, opt.num_workers, opt.seed, opt.valid_fraction, opt.test_fraction)
@@ -0,0 +1,290 @@
+from __future__ import division
+import tensorflow as tf
+import numpy as np
+import cv2
+import os
+import json
+import hashlib
+import multiprocessing
+import time
+import record_io
+import build_manifest
+import record_meta
+
+#==================================
+# Convert the frames of a capture manifest
+# to sharded v2 tfrecords
+#==================================
+# Frames come from the frames.json of build_manifest.py. The images are the
+# PNGs of the frame, the ground truth its annotation.json:
+#   {"quaternion": [4], "translation": [3], "H": [3,3], "matK": [3,3],
+#    "points2D": [2,28], "visibility": [28]}
+# Every sequence is cut into chunks of chunk_frames consecutive frames and
+# a chunk goes to the shard drawn from the hash of (sequence, chunk number),
+# so adding or removing frames only changes the shards of the chunks they
+# fall in. A shard is written by one worker to a temporary file that is
+# renamed when complete. Finished shards are listed in progress.json with a
+# digest of their frames, a re-run or an interrupted conversion redoes only
+# the others. frames.txt lists the frame of every record in the order of
+# the shards (record_meta.py takes the sequences of the records from it).
+# Splits without any mask (test) get empty masks instead of being skipped.
+
+flags = tf.app.flags
+flags.DEFINE_string("manifest_dir", "/home/z003xr2y/data/tset/", "Directory of frames.json")
+flags.DEFINE_string("split", "train", "Split of the manifest to convert")
+flags.DEFINE_string("output_dir", "/home/z003xr2y/data/data/tfrecords_tset_v2/", "Directory for the shards")
+flags.DEFINE_integer("num_shards", 64, "Number of shards")
+flags.DEFINE_integer("chunk_frames", 64, "Consecutive frames of a sequence kept together in one shard")
+flags.DEFINE_integer("num_workers", 8, "Number of converting processes")
+flags.DEFINE_integer("img_height", 480, "Image height")
+flags.DEFINE_integer("img_width", 640, "Image width")
+flags.DEFINE_string("compression", "NONE", "NONE ZLIB GZIP")
+opt = flags.FLAGS
+
+PROGRESS_NAME = 'progress.json'
+
+
+def record_shapes(image_height, image_width):
+    '''
+    Shape every record feature must have
+    '''
+    H = image_height
+    W = image_width
+    return {
+        'color': [H, W, 3],
+        'IR': [H, W],
+        'depth': [H, W],
+        'mask': [H, W],
+        'quaternion': [4],
+        'translation': [3],
+        'visibility': [record_io.NUM_LANDMARKS],
+        'matK': [3, 3],
+        'H': [3, 3],
+        'points2D': [2, record_io.NUM_LANDMARKS],
+    }
+
+
+def read_frame(prefix, with_mask=True):
+    '''
+    Arrays of one frame, named as the record features. Without with_mask
+    the mask is empty.
+    '''
+    files = build_manifest.frame_files(prefix)
+
+    def read_png(path):
+        image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise ValueError('cannot read %s' % path)
+        return image
+
+    color = read_png(files['image'])
+    IR = read_png(files['IR'])
+    depth = read_png(files['depth'])
+    if with_mask:
+        mask = read_png(files['label'])
+    else:
+        mask = np.zeros(depth.shape[:2], dtype=np.uint8)
+    with open(files['annotation'], 'r') as f:
+        annotation = json.load(f)
+
+    frame = {
+        # cv2 reads BGR, decode_png in the PNG loader gives RGB
+        'color': cv2.cvtColor(color[:, :, :3], cv2.COLOR_BGR2RGB) if color.ndim == 3 else color,
+        'IR': IR[:, :, 0] if IR.ndim == 3 else IR,
+        'depth': depth[:, :, 0] if depth.ndim == 3 else depth,
+        'mask': mask[:, :, 0] if mask.ndim == 3 else mask,
+    }
+    for key in ['quaternion', 'translation', 'visibility', 'matK', 'H', 'points2D']:
+        frame[key] = np.asarray(annotation[key], dtype=np.float64)
+    return frame
+
+
+def validate_frame(frame, shapes):
+    '''
+    Raises ValueError if a feature has the wrong shape or dtype or is not
+    finite
+    '''
+    for key, shape in shapes.items():
+        value = frame[key]
+        if list(value.shape) != shape:
+            raise ValueError('%s has shape %s, expected %s' % (key, list(value.shape), shape))
+        if not np.all(np.isfinite(value)):
+            raise ValueError('%s is not finite' % key)
+    # The records store these as is, a 16-bit image would not fit
+    for key, dtype in [('color', np.uint8), ('IR', np.uint8), ('mask', np.uint8), ('depth', np.uint16)]:
+        if frame[key].dtype != dtype:
+            raise ValueError('%s is %s, expected %s' % (key, frame[key].dtype, np.dtype(dtype).name))
+
+
+def convert_shard(args):
+    '''
+    Write one shard.
+    Args:
+        args: (root, prefixes, output_dir, shard file name, image_height,
+               image_width, compression, with_mask)
+    Returns:
+        ({file, num_records, bytes}, prefixes of the written records,
+         [(prefix, error)] of the skipped frames)
+    '''
+    root, prefixes, output_dir, name, image_height, image_width, compression, with_mask = args
+    shapes = record_shapes(image_height, image_width)
+    path = os.path.join(output_dir, name)
+    writer = tf.python_io.TFRecordWriter(path+'.tmp', record_io.record_options(compression))
+    count = 0
+    nbytes = 0
+    written = []
+    skipped = []
+    for prefix in prefixes:
+        try:
+            frame = read_frame(os.path.join(root, prefix), with_mask)
+            validate_frame(frame, shapes)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            skipped.append((prefix, str(e)))
+            continue
+        serialized = record_io.encode_example_v2(**frame).SerializeToString()
+        writer.write(serialized)
+        written.append(prefix)
+        count += 1
+        nbytes += len(serialized)
+    writer.close()
+    os.rename(path+'.tmp', path)
+    return {'file': name, 'num_records': count, 'bytes': nbytes}, written, skipped
+
+
+def shard_frames(prefixes, num_shards, chunk_frames):
+    '''
+    Frames of every shard: chunks of chunk_frames consecutive frames of a
+    sequence, each in the shard drawn from (sequence, chunk number)
+    '''
+    sequences = {}
+    for prefix in prefixes:
+        sequences.setdefault(os.path.dirname(prefix), []).append(prefix)
+    shards = [[] for _ in range(num_shards)]
+    for sequence in sorted(sequences.keys()):
+        frames = sorted(sequences[sequence], key=build_manifest.frame_sort_key)
+        for chunk, start in enumerate(range(0, len(frames), chunk_frames)):
+            digest = hashlib.sha1(('%s#%d' % (sequence, chunk)).encode('utf-8')).hexdigest()
+            shards[int(digest[:8], 16) % num_shards] += frames[start:start+chunk_frames]
+    return shards
+
+
+def has_masks(manifest, prefixes):
+    '''
+    True if any frame of prefixes has a mask file in the manifest
+    '''
+    for prefix in prefixes:
+        mask = os.path.relpath(build_manifest.frame_files(os.path.join(manifest['root'], prefix))['label'],
+                               manifest['root'])
+        if mask in manifest['frames'][prefix]:
+            return True
+    return False
+
+
+def frames_digest(manifest, prefixes):
+    '''
+    Digest of the frames of a shard and of the sha1 of each of their files,
+    so an edited image or annotation reconverts its shard
+    '''
+    sha = hashlib.sha1()
+    for prefix in prefixes:
+        sha.update((prefix+'\n').encode('utf-8'))
+        files = manifest['frames'][prefix]
+        for path in sorted(files.keys()):
+            sha.update(('%s %s\n' % (path, files[path]['sha1'])).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def load_progress(output_dir, config):
+    '''
+    {shard file: {shard, digest, frames, skipped}} of the finished shards of a
+    conversion with the same config, empty otherwise
+    '''
+    path = os.path.join(output_dir, PROGRESS_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        progress = json.load(f)
+    if progress['config'] != config:
+        print("Conversion settings changed, starting over")
+        return {}
+    return dict([(name, done) for name, done in progress['shards'].items()
+                 if os.path.exists(os.path.join(output_dir, name))])
+
+
+def save_progress(output_dir, config, shards):
+    path = os.path.join(output_dir, PROGRESS_NAME)
+    with open(path+'.tmp', 'w') as f:
+        json.dump({'config': config, 'shards': shards}, f, indent=2)
+    os.rename(path+'.tmp', path)
+
+
+def convert(manifest_dir, split, output_dir, num_shards, num_workers, image_height, image_width, compression='NONE',
+            chunk_frames=64):
+    '''
+    Convert the frames of split to num_shards shards and a manifest.json
+    '''
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    manifest = build_manifest.load_manifest(manifest_dir)
+    if manifest is None:
+        raise ValueError('no %s in %s, run build_manifest.py first' % (build_manifest.MANIFEST_NAME, manifest_dir))
+    prefixes = manifest['splits'][split]
+    with_mask = has_masks(manifest, prefixes)
+    if not with_mask:
+        print("No masks in the %s split, writing empty masks" % split)
+    config = {'root': manifest['root'],
+              'split': split,
+              'num_shards': num_shards,
+              'chunk_frames': chunk_frames,
+              'with_mask': with_mask,
+              'img_height': image_height,
+              'img_width': image_width,
+              'compression': compression}
+
+    names = [record_io.shard_name(i, num_shards) for i in range(num_shards)]
+    frames = shard_frames(prefixes, num_shards, chunk_frames)
+    done = load_progress(output_dir, config)
+    jobs = []
+    for i, name in enumerate(names):
+        shard_prefixes = frames[i]
+        digest = frames_digest(manifest, shard_prefixes)
+        # A finished shard is kept only if it holds the same frames
+        if name in done and done[name]['digest'] == digest:
+            continue
+        done.pop(name, None)
+        jobs.append((digest, (manifest['root'], shard_prefixes, output_dir, name, image_height, image_width, compression,
+                              with_mask)))
+    print("Converting %d frames: %d/%d shards left" % (len(prefixes), len(jobs), num_shards))
+
+    start = time.time()
+    digests = dict([(job[3], digest) for digest, job in jobs])
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for shard, written, skipped in pool.imap_unordered(convert_shard, [job for _, job in jobs]):
+            done[shard['file']] = {'shard': shard,
+                                   'digest': digests[shard['file']],
+                                   'frames': written,
+                                   'skipped': skipped}
+            save_progress(output_dir, config, done)
+            for prefix, error in skipped:
+                print("Skipped %s: %s" % (prefix, error))
+            print("Wrote %s (%d records, %d/%d shards, %.1fs)" % (
+                shard['file'], shard['num_records'], len(done), num_shards, time.time()-start))
+    finally:
+        pool.close()
+        pool.join()
+
+    result = record_io.write_manifest(output_dir, record_io.RECORD_V2, compression,
+                                      [done[name]['shard'] for name in names])
+    with open(os.path.join(output_dir, record_meta.FRAMES_NAME), 'w') as f:
+        for name in names:
+            for prefix in done[name]['frames']:
+                f.write(prefix+'\n')
+    num_skipped = sum([len(done[name]['skipped']) for name in names])
+    print("Wrote %d records to %s, %d frames skipped" % (result['num_records'], output_dir, num_skipped))
+    return result
+
+
+if __name__ == "__main__":
+    convert(opt.manifest_dir, opt.split, opt.output_dir, opt.num_shards, opt.num_workers,
+            opt.img_height, opt.img_width, opt.compression, opt.chunk_frames)
@@ -0,0 +1,51 @@
+import tensorflow as tf
+import os, glob
+import record_io
+
+#==================================
+# Convert v1 tfrecords (dense heatmaps, float images)
+# to the compact v2 schema
+#==================================
+
+flags = tf.app.flags
+flags.DEFINE_string("input_dir", "/home/z003xr2y/data/data/tfrecords_hr_filldepth/", "Directory of v1 tfrecords")
+flags.DEFINE_string("output_dir", "/home/z003xr2y/data/data/tfrecords_hr_filldepth_v2/", "Directory for the v2 tfrecords")
+flags.DEFINE_integer("img_height", 480, "Image height")
+flags.DEFINE_integer("img_width", 640, "Image width")
+flags.DEFINE_string("compression", "NONE", "Compression of the v2 tfrecords: NONE ZLIB GZIP")
+opt = flags.FLAGS
+
+
+def convert(input_dir, output_dir, image_height, image_width, compression='NONE'):
+    '''
+    Convert every *.tfrecords file of input_dir, keeping the file names
+    '''
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    filenames = sorted(glob.glob(os.path.join(input_dir, '*.tfrecords')))
+    options = record_io.record_options(compression)
+    sigma = None
+    count = 0
+    for filename in filenames:
+        outname = os.path.join(output_dir, os.path.basename(filename))
+        writer = tf.python_io.TFRecordWriter(outname, options)
+        input_options = record_io.record_options(record_io.detect_compression(filename))
+        for serialized in tf.python_io.tf_record_iterator(filename, input_options):
+            if sigma is None:
+                sigma = record_io.estimate_heatmap_sigma(serialized, image_height, image_width)
+            example = record_io.example_v1_to_v2(serialized, image_height, image_width)
+            writer.write(example.SerializeToString())
+            count += 1
+        writer.close()
+        print("Converted %s (%d records so far)" % (filename, count))
+
+    # Same files in the same order, the frames do not move
+    record_io.write_frames(output_dir, record_io.read_frames(input_dir), count)
+
+    if sigma is not None:
+        print("Estimated heatmap sigma of the v1 records: %.2f (train with --hm_sigma=%.2f)" % (sigma, sigma))
+
+
+if __name__ == "__main__":
+    convert(opt.input_dir, opt.output_dir, opt.img_height, opt.img_width, opt.compression)
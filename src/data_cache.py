@@ -0,0 +1,194 @@
+import tensorflow as tf
+import os, glob
+import errno
+import hashlib
+import json
+import shutil
+import socket
+import time
+
+#==================================
+# Persistent cache of decoded examples
+#==================================
+# Every cache entry is a folder <cache_dir>/<key>/ holding the tf.data cache
+# files and a meta.json. The key covers the dataset path, the decode config
+# and a hash of the record files, so a changed config or rewritten dataset
+# gets a new entry. Entries are only evicted least recently used first when
+# the cache is over budget, so runs with different configs can share it.
+# The run filling an entry records itself in writer.json; other runs leave
+# an entry with a live writer alone and read their examples uncached.
+
+META_NAME = 'meta.json'
+WRITER_NAME = 'writer.json'
+# A writer on another host (or a lock without writer) older than this is
+# taken as dead
+STALE_WRITER_SECONDS = 24*3600
+
+# Loader options that change what the decode stage produces
+CONFIG_KEYS = ['img_height', 'img_width', 'downsample', 'inputs', 'render_hm', 'roi_crop']
+
+
+def content_hash(filenames, head_bytes=1<<20):
+    '''
+    Hash of the record files: name, size and the first head_bytes of each.
+    Cheap enough to run at every start on large datasets.
+    '''
+    sha = hashlib.sha1()
+    for filename in sorted(filenames):
+        sha.update(os.path.basename(filename).encode('utf-8'))
+        sha.update(str(os.path.getsize(filename)).encode('utf-8'))
+        with open(filename, 'rb') as f:
+            sha.update(f.read(head_bytes))
+    return sha.hexdigest()
+
+
+def cache_config(dataset_dir, filenames, opt, extra=None):
+    '''
+    Everything the cached examples depend on
+    '''
+    config = {'dataset_dir': os.path.abspath(dataset_dir),
+              'content_hash': content_hash(filenames)}
+    for key in CONFIG_KEYS:
+        config[key] = getattr(opt, key, None)
+    if extra is not None:
+        config.update(extra)
+    return config
+
+
+def cache_key(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def entry_size(entry_dir):
+    size = 0
+    for filename in glob.glob(os.path.join(entry_dir, '*')):
+        size += os.path.getsize(filename)
+    return size
+
+
+def read_meta(entry_dir):
+    path = os.path.join(entry_dir, META_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def writer_alive(entry_dir):
+    '''
+    True if another run may still be writing entry_dir: its writer.json
+    names a live process on this host, or, for writers on other hosts and
+    tf.data lock files without a writer.json, they are recent
+    '''
+    path = os.path.join(entry_dir, WRITER_NAME)
+    locks = glob.glob(os.path.join(entry_dir, '*.lockfile'))
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                writer = json.load(f)
+        except ValueError:
+            # Being written right now
+            return True
+        if writer['host'] == socket.gethostname():
+            return pid_alive(writer['pid'])
+        return time.time()-writer['started'] < STALE_WRITER_SECONDS
+    for lockfile in locks:
+        if time.time()-os.path.getmtime(lockfile) < STALE_WRITER_SECONDS:
+            return True
+    return False
+
+
+def claim_entry(entry_dir):
+    '''
+    Make this run the writer of an incomplete entry, clearing the lock
+    files of a dead writer. False if another run writes it.
+    '''
+    if writer_alive(entry_dir):
+        return False
+    for lockfile in glob.glob(os.path.join(entry_dir, '*.lockfile')):
+        os.remove(lockfile)
+    path = os.path.join(entry_dir, WRITER_NAME)
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        # Exclusive create, of two runs starting together only one wins
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'started': time.time()}, f)
+    return True
+
+
+def evict(cache_dir, key, budget_bytes):
+    '''
+    Remove the least recently used entries until the cache fits in
+    budget_bytes. The entry of key and entries being written are never
+    removed.
+    '''
+    entries = []
+    for entry_dir in glob.glob(os.path.join(cache_dir, '*')):
+        if not os.path.isdir(entry_dir) or os.path.basename(entry_dir) == key:
+            continue
+        meta = read_meta(entry_dir)
+        last_used = meta['last_used'] if meta is not None else os.path.getmtime(entry_dir)
+        entries.append((last_used, entry_dir))
+
+    total = entry_size(os.path.join(cache_dir, key))
+    for _, entry_dir in entries:
+        total += entry_size(entry_dir)
+    for _, entry_dir in sorted(entries):
+        if total <= budget_bytes:
+            break
+        if writer_alive(entry_dir) and not is_complete(entry_dir):
+            continue
+        print("Evicting cache entry %s (cache over budget)" % entry_dir)
+        total -= entry_size(entry_dir)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+
+def is_complete(entry_dir):
+    return len(glob.glob(os.path.join(entry_dir, 'data*.index'))) > 0
+
+
+def cached_dataset(dataset, cache_dir, config, budget_gb):
+    '''
+    Cache a dataset of decoded examples.
+    Args:
+        dataset: A finite tf.data.Dataset (one pass over the records)
+        cache_dir: "memory" or a directory for persistent entries
+        config: Output of cache_config
+        budget_gb: Size budget of cache_dir
+    Returns:
+        The cached dataset. A disk entry is complete after the first full pass
+        and is read back by later runs with the same config.
+    '''
+    if cache_dir == "memory":
+        return dataset.cache()
+
+    key = cache_key(config)
+    entry_dir = os.path.join(cache_dir, key)
+    if not os.path.exists(entry_dir):
+        os.makedirs(entry_dir)
+    meta = read_meta(entry_dir) or {'config': config, 'created': time.time()}
+    meta['last_used'] = time.time()
+    with open(os.path.join(entry_dir, META_NAME), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    evict(cache_dir, key, budget_gb*(1<<30))
+    if is_complete(entry_dir):
+        print("Reading cached examples from %s" % entry_dir)
+    elif claim_entry(entry_dir):
+        print("Caching examples to %s" % entry_dir)
+    else:
+        print("Cache entry %s is being written by another run, reading uncached" % entry_dir)
+        return dataset
+    return dataset.cache(os.path.join(entry_dir, 'data'))
@@ -5,6 +5,102 @@ import random
 import numpy as np
 import os, glob
 import utils_lr as utlr
+import record_io
+import data_cache
+import memmap_dataset
+import record_index
+import build_manifest
+import record_meta
+import pair_sampler
+import dedup_records
+
+
+# Record feature holding each data_dict key ('points2D' is the dense
+# heatmap, 'pixel_coords' the landmark coordinates)
+DATA_FEATURES = {
+    'image': 'color',
+    'IR': 'IR',
+    'depth': 'depth',
+    'label': 'mask',
+    'quaternion': 'quaternion',
+    'translation': 'translation',
+    'points2D': 'landmark_heatmap',
+    'visibility': 'visibility',
+    'matK': 'matK',
+    'pixel_coords': 'points2D',
+}
+
+# Batches the evaluation stream prefetches
+EVAL_PREFETCH = 2
+
+# Modalities stored as PNG in the capture folders: record feature ->
+# (decode_png dtype, channels)
+PNG_FORMATS = {
+    'color': (tf.uint8, 3),
+    'IR': (tf.uint8, 1),
+    'depth': (tf.uint16, 1),
+    'mask': (tf.uint8, 1),
+}
+PNG_FEATURES = ['image', 'IR', 'depth', 'label']
+
+# data_dict keys concatenated into the network input for each --inputs
+INPUT_FEATURES = {
+    'all': ['IR', 'depth', 'image'],
+    'IR_depth': ['IR', 'depth'],
+    'depth_color': ['depth', 'image'],
+    'IR_color': ['IR', 'image'],
+    'IR': ['IR'],
+    'color': ['image'],
+    'depth': ['depth'],
+    'hm': ['points2D'],
+}
+
+
+def element_bytes(dataset):
+    '''
+    Bytes of one element of an unbatched dataset with static shapes
+    '''
+    shapes = tf.contrib.framework.nest.flatten(dataset.output_shapes)
+    types = tf.contrib.framework.nest.flatten(dataset.output_types)
+    total = 0
+    for shape, dtype in zip(shapes, types):
+        total += int(np.prod(shape.as_list()))*dtype.size
+    return total
+
+
+def define_loader_flags(flags):
+    '''
+    Define the input pipeline flags shared by main.py, benchmark_input.py
+    and eval_report.py on tf.app.flags
+    '''
+    flags.DEFINE_integer("record_height", 0, "Image height stored in the dataset, resampled to img_height (0: same as img_height)")
+    flags.DEFINE_integer("record_width", 0, "Image width stored in the dataset, resampled to img_width (0: same as img_width)")
+    flags.DEFINE_boolean("downsample", False, "Data augment")
+    flags.DEFINE_float("hm_sigma", 5.0, "Sigma (pixels) of the heatmaps rendered from landmark coordinates")
+    flags.DEFINE_float("hm_sigma_start", 0.0, "Initial heatmap sigma, decays to hm_sigma over change_gauss steps (0: constant)")
+    flags.DEFINE_integer("change_gauss", 2000, "Number of steps of the heatmap sigma schedule")
+    flags.DEFINE_boolean("render_hm", False, "Render heatmaps from coordinates instead of reading them from v1 records")
+    flags.DEFINE_boolean("batch_parse", False, "Batch serialized records before parsing them with one parse_example per batch")
+    flags.DEFINE_integer("cycle_length", 4, "Number of record files read in parallel")
+    flags.DEFINE_string("cache_dir", "None", "Cache decoded examples: None, memory or a directory")
+    flags.DEFINE_float("cache_budget_gb", 50.0, "Size budget of the cache directory")
+    flags.DEFINE_float("shuffle_buffer_mb", 1024.0, "Byte budget of the inputs_test shuffle buffer")
+    flags.DEFINE_boolean("two_level_shuffle", False, "inputs_test: shuffle the file order, then a small element buffer")
+    flags.DEFINE_boolean("global_shuffle", False, "Read records by offset in a global permutation per epoch instead of a shuffle buffer")
+    flags.DEFINE_integer("shuffle_seed", 0, "Seed of the global permutations")
+    flags.DEFINE_integer("skip_records", 0, "Records skipped at the start of the stream (with global_shuffle)")
+    flags.DEFINE_integer("subset_size", 0, "Train on a fixed random subset of this many records (with global_shuffle, 0: all)")
+    flags.DEFINE_integer("min_visible", 0, "Skip records with fewer visible landmarks, from the record metadata (0: keep all)")
+    flags.DEFINE_string("sample_weights", "none", "Record sampling with global_shuffle: none, visible (by visible landmarks) or sequence (sequences equally often)")
+    flags.DEFINE_boolean("dedup", False, "One frame per near-duplicate cluster per epoch (run dedup_records.py first)")
+    flags.DEFINE_boolean("pair_sampling", False, "Batches of frame pairs from one sequence sharing visible landmarks, for the pose/H/DH losses")
+    flags.DEFINE_integer("pair_min_shared", 6, "Visible landmarks a frame pair must share (with pair_sampling)")
+    flags.DEFINE_boolean("roi_crop", False, "Train on a window around the visible landmarks resampled to img_height x img_width (decoded at record_height x record_width)")
+    flags.DEFINE_float("roi_margin", 0.15, "Margin of the ROI window on every side, relative to the landmark extent")
+    flags.DEFINE_float("roi_jitter", 0.1, "Random ROI window scale and shift during training, relative to its size")
+    flags.DEFINE_string("color_jitter", "none", "Color augmentation: none, example (in data_augmentation2) or batch (after batching)")
+    flags.DEFINE_integer("num_producers", 0, "Decode and augment in this many worker processes (0: in the tf.data pipeline)")
+    flags.DEFINE_integer("producer_slots", 2, "Shared-memory batches per producer process")
 
 
 class DataLoader(object):
@@ -21,6 +117,14 @@ class DataLoader(object):
         self.image_width=image_width
         self.split=split
         self.opt = opt
+        # Resolution stored in the records; every spatial modality is
+        # resampled to image_height x image_width when they differ
+        self.record_height=getattr(opt,'record_height',0) or image_height
+        self.record_width=getattr(opt,'record_width',0) or image_width
+        # (worker, num_workers) in a producer process
+        self.worker_shard=None
+        # Set by record_files when the workers split the records of every file
+        self.record_shard=None
 
 
 
@@ -44,96 +148,40 @@ class DataLoader(object):
             This function creates a one_shot_iterator, meaning that it will only iterate
             over the dataset once. On the other hand there is no special initialization
             required.
+        The stream is always augmented, as it always was; with_aug (--data_aug,
+        which only names the checkpoint directory) does not turn it off.
         """
         def decode(serialized_example):
             """Parses an image and label from the given `serialized_example`."""
-            features = tf.parse_single_example(
-                serialized_example,
-                # Defaults are not specified since both keys are required.
-                features={
-                    'color': tf.FixedLenFeature([], tf.string),
-                    'IR': tf.FixedLenFeature([], tf.string),
-                    'depth': tf.FixedLenFeature([], tf.string),
-                    'mask': tf.FixedLenFeature([], tf.string),
-				    'quaternion': tf.FixedLenFeature([], tf.string),
-				    'translation': tf.FixedLenFeature([], tf.string),
-                    'landmark_heatmap': tf.FixedLenFeature([], tf.string),
-                    'visibility': tf.FixedLenFeature([], tf.string),
-                    'matK': tf.FixedLenFeature([], tf.string),
-                    'H': tf.FixedLenFeature([], tf.string),
-                    'points2D': tf.FixedLenFeature([], tf.string),
-                })
-
-            # Convert from a scalar string tensor (whose single string has
-            # length mnist.IMAGE_PIXELS) to a uint8 tensor with shape
-            # [mnist.IMAGE_PIXELS].
-            image = tf.decode_raw(features['color'], tf.float64)
-            IR = tf.decode_raw(features['IR'], tf.float32)
-            depth = tf.decode_raw(features['depth'], tf.float32)#/100.0
-            label = tf.decode_raw(features['mask'], tf.uint8)
-            quaternion = tf.decode_raw(features['quaternion'], tf.float64)
-            translation = tf.decode_raw(features['translation'], tf.float64)
-            points2D = tf.decode_raw(features['landmark_heatmap'], tf.float32)
-            visibility = tf.decode_raw(features['visibility'], tf.float32)
-            matK = tf.decode_raw(features['matK'], tf.float64)
-            H = tf.decode_raw(features['H'], tf.float64)
-            pixel_coords = tf.decode_raw(features['points2D'], tf.float64)
-
-            image =  tf.cast(tf.reshape(image,[self.image_height, self.image_width, 3]),tf.float32)/255.0-0.5
-
-            IR = tf.cast(tf.reshape(IR,[self.image_height, self.image_width, 3]),tf.float32)/255.0-0.5
-            
-            IR = tf.expand_dims(IR[:,:,0],axis=2)
-
-            depth = tf.cast(tf.reshape(depth,[self.image_height, self.image_width, 1]),tf.float32)
-            label = tf.reshape(label,[self.image_height, self.image_width, 1])
-            quaternion = tf.cast(tf.reshape(quaternion,[4]),tf.float32)
-
-            translation = tf.cast(tf.reshape(translation,[3]),tf.float32)
-            #import pdb;pdb.set_trace()
-            norm = tf.sqrt(tf.reduce_sum(tf.square(translation),0, keep_dims=True))
-            translation = translation / norm
-            translation = tf.concat([translation,norm],axis=0)
-            
-            #import pdb;pdb.set_trace()
-            points2D = tf.reshape(points2D,[self.image_height, self.image_width,28])#*(self.image_height*self.image_width)/10.0
-            div = tf.tile(tf.expand_dims(tf.expand_dims(tf.reduce_max(points2D,[0,1])+0.0000001,axis=0),axis=1),[self.image_height,self.image_width,1])
-            points2D = points2D/div
-            #points2D = points2D*(self.image_height*self.image_width)
-
-            pixel_coords = tf.cast(tf.reshape(pixel_coords,[2,28]),dtype=tf.float32)
-
-            if self.opt.downsample:
-                image = tf.image.resize_images(image,[224,224])
-                IR = tf.image.resize_images(IR,[224,224])
-
-
-            visibility.set_shape([28])
-            visibility = tf.cast(visibility,tf.float32)
-            matK = tf.cast(tf.reshape(matK,[3,3]),tf.float32)
-
-            # Convert label from a scalar uint8 tensor to an int32 scalar.
-            label = tf.cast(label, tf.float32)/255.0
-
+            data_dict = self.decode_record(serialized_example, version, rescale=not self.opt.roi_crop)
 
+            return data_dict
 
-            #Data augmentationmamatK
-            data_dict = {}
-            data_dict['image'] = image
-            data_dict['IR'] = IR
-            data_dict['depth'] = depth
-            data_dict['label'] = label
-            data_dict['quaternion'] = quaternion
-            data_dict['translation'] = translation
-            data_dict['points2D'] = points2D
-            data_dict['visibility'] = visibility
-            data_dict['matK'] = matK
-            data_dict['pixel_coords'] = pixel_coords
+        def render(index, data_dict):
+            """Renders the landmark heatmaps for records without dense ones."""
+            roi_scale = data_dict.pop('roi_scale', None)
+            if 'points2D' in needed and 'points2D' not in data_dict:
+                sigma = self.heatmap_sigma(self.schedule_step(index//batch_size), roi_scale)
+                data_dict['points2D'] = self.render_heatmaps(data_dict['pixel_coords'],
+                                                             data_dict['visibility'],
+                                                             sigma,
+                                                             self.image_height,
+                                                             self.image_width)
+            return data_dict
 
+        def augment2(data_dict):
             data_dict = self.data_augmentation2(data_dict,self.image_height,self.image_width)
-
             return data_dict
 
+        def augment_render(index, data_dict):
+            """Warps the images and coordinates, then renders the heatmaps from
+            the warped coordinates (only dense v1 heatmaps are warped)."""
+            if self.opt.roi_crop:
+                data_dict = self.roi_crop(data_dict,self.image_height,self.image_width,True)
+            else:
+                data_dict = augment2(data_dict)
+            return render(index, data_dict)
+
         def augment(data_dict):
         
             ir_batch, image_batch, depth_batch, label_batch,landmark_batch,matK = self.data_augmentation(
@@ -153,31 +201,56 @@ class DataLoader(object):
             data_dict['matK'] = matK
             
             return data_dict
-        def augment2(data_dict):
-            data_dict = self.data_augmentation2(data_dict,self.image_height,self.image_width)
+
+        if self.is_png_dataset():
+            return self.inputs_png(batch_size, num_epochs, True)
+        if self.opt.batch_parse and not memmap_dataset.is_memmap_dataset(self.dataset_dir):
+            if self.opt.cache_dir != "None":
+                raise ValueError('--batch_parse decodes whole batches, there are no decoded examples for --cache_dir')
+            return self.inputs_batched(batch_size, num_epochs)
 
         if not num_epochs:
             num_epochs = None
-        filenames = glob.glob(os.path.join(self.dataset_dir,'*.tfrecords'))
+        needed = self.required_features()
+        self.check_pair_batch(batch_size)
 
         with tf.name_scope('input'):
-            # TFRecordDataset opens a binary file and reads one record at a time.
-            # `filename` could also be a list of filenames, which will be read in order.
-            dataset = tf.data.TFRecordDataset(filenames)
-
-            # The map transformation takes a function and applies it to every element
-            # of the dataset.
-            dataset = dataset.map(decode,num_parallel_calls=8)
-            #dataset = dataset.map(augment2)
-            # dataset = dataset.map(normalize)
-
-            # The shuffle transformation uses a finite-sized buffer to shuffle elements
-            # in memory. The parameter is the number of elements in the buffer. For
-            # completely uniform shuffling, set the parameter to be the same as the
-            # number of elements in the dataset.
-            dataset = dataset.shuffle(100)#1000 + 3 * batch_size)
-            dataset = dataset.repeat(num_epochs)
+            if memmap_dataset.is_memmap_dataset(self.dataset_dir):
+                # Random access, the example order is a full permutation
+                dataset = self.memmap_source(num_epochs, self.decoded_features(True), skip=self.opt.skip_records,
+                                             rescale=not self.opt.roi_crop)
+            elif self.indexed_order():
+                # Every epoch is a permutation of all records (or of pairs of
+                # them), no shuffle buffer
+                filenames = self.record_files(seekable=True)
+                version, compression = record_io.detect_record_format(self.dataset_dir, filenames)
+                dataset = self.indexed_records(filenames, num_epochs, compression)
+                dataset = dataset.map(decode,num_parallel_calls=8)
+            else:
+                filenames = self.record_files()
+                version, compression = record_io.detect_record_format(self.dataset_dir, filenames)
+                # Files are shuffled every epoch and read in parallel, the decoded
+                # examples come from the cache with --cache_dir
+                dataset = self.decoded_dataset(filenames, num_epochs, compression, decode,
+                                               {'version': version, 'features': sorted(needed)},
+                                               version=version)
+                # dataset = dataset.map(normalize)
+
+                # The shuffle transformation uses a finite-sized buffer to shuffle elements
+                # in memory. The parameter is the number of elements in the buffer. For
+                # completely uniform shuffling, set the parameter to be the same as the
+                # number of elements in the dataset.
+                dataset = dataset.shuffle(100)#1000 + 3 * batch_size)
+
+            # Heatmaps are rendered after the shuffle and the augmentation, so
+            # neither the buffer nor the warp touch them; the element index
+            # drives the sigma schedule.
+            dataset = tf.data.Dataset.zip((tf.data.Dataset.range(self.opt.skip_records, np.iinfo(np.int64).max), dataset))
+            dataset = dataset.map(augment_render,num_parallel_calls=8)
             dataset = dataset.batch(batch_size)
+            if self.opt.color_jitter == "batch":
+                # One jitter op per batch instead of per example
+                dataset = dataset.map(self.jitter_colors,num_parallel_calls=2)
             #if with_aug is not None:
             #dataset = dataset.map(augment)
 
@@ -185,6 +258,73 @@ class DataLoader(object):
         return dataset#iterator.get_next()
 
 
+    #==================================
+    # Load training data from tf records, parsing whole batches
+    #==================================
+
+    def inputs_batched(self,batch_size, num_epochs,with_aug=True):
+        """Same stream as inputs(), but the serialized records are batched
+        first and every batch is parsed with a single tf.parse_example, so
+        the reshape, cast, normalization and heatmap ops run once per batch
+        instead of once per example (--batch_parse).
+        """
+        def decode(index, serialized_batch):
+            """Parses a batch of serialized records."""
+            return index, self.decode_record(serialized_batch, version, batched=True, rescale=not self.opt.roi_crop)
+
+        def augment_render(index, data_dict):
+            """Warps the batch, then renders its heatmaps from the warped coordinates."""
+            if self.opt.roi_crop:
+                # The window is drawn per example
+                dtypes = dict([(key, value.dtype) for key, value in data_dict.items()])
+                dtypes['roi_scale'] = tf.float32
+                data_dict = tf.map_fn(lambda example: self.roi_crop(example,self.image_height,self.image_width,with_aug),
+                                      data_dict, dtype=dtypes)
+                if with_aug and self.opt.color_jitter == "batch":
+                    data_dict = self.jitter_colors(data_dict)
+            elif with_aug:
+                # The random warp is drawn per example
+                data_dict = tf.map_fn(lambda example: self.data_augmentation2(example,self.image_height,self.image_width),
+                                      data_dict)
+                if self.opt.color_jitter == "batch":
+                    data_dict = self.jitter_colors(data_dict)
+            roi_scale = data_dict.pop('roi_scale', None)
+            if 'points2D' in needed and 'points2D' not in data_dict:
+                data_dict['points2D'] = self.render_heatmaps(data_dict['pixel_coords'],
+                                                             data_dict['visibility'],
+                                                             self.heatmap_sigma(self.schedule_step(index), roi_scale),
+                                                             self.image_height,
+                                                             self.image_width)
+            return data_dict
+
+        if not num_epochs:
+            num_epochs = None
+        seekable = self.indexed_order()
+        filenames = self.record_files(seekable)
+        version, compression = record_io.detect_record_format(self.dataset_dir, filenames)
+        needed = self.required_features()
+        self.check_pair_batch(batch_size)
+
+        with tf.name_scope('input'):
+            if seekable:
+                dataset = self.indexed_records(filenames, num_epochs, compression)
+            else:
+                dataset = self.record_dataset(filenames, num_epochs, compression)
+                # Before batching, so the batches stay full
+                dataset = self.filter_visible(dataset, version)
+                # Shuffling serialized strings is cheaper than shuffling decoded tensors
+                dataset = dataset.shuffle(100)
+            dataset = dataset.batch(batch_size)
+
+            # The batch index drives the sigma schedule
+            dataset = tf.data.Dataset.zip((tf.data.Dataset.range(self.opt.skip_records//batch_size, np.iinfo(np.int64).max), dataset))
+            dataset = dataset.map(decode,num_parallel_calls=2)
+            dataset = dataset.map(augment_render,num_parallel_calls=2)
+            dataset = dataset.prefetch(1)
+
+        return dataset
+
+
     #==================================
     # Load training data from tf records
     #==================================
@@ -210,28 +350,13 @@ class DataLoader(object):
             """Parses an image and label from the given `serialized_example`."""
             features = tf.parse_single_example(
                 serialized_example,
-                # Defaults are not specified since both keys are required.
-                features={
-                    'color': tf.FixedLenFeature([], tf.string),
-                    'IR': tf.FixedLenFeature([], tf.string),
-                    'depth': tf.FixedLenFeature([], tf.string),
-                    'matK': tf.FixedLenFeature([], tf.string),
-                })
-
-            # Convert from a scalar string tensor (whose single string has
-            # length mnist.IMAGE_PIXELS) to a uint8 tensor with shape
-            # [mnist.IMAGE_PIXELS].
-            image = tf.decode_raw(features['color'], tf.float64)/255.0-0.5
-            IR = tf.decode_raw(features['IR'], tf.float32)/255.0-0.5
-            
-            depth = tf.decode_raw(features['depth'], tf.float32)#/100.0
-            matK = tf.decode_raw(features['matK'], tf.float64)
+                features=record_io.record_features(version,['color','IR','depth','matK']))
 
-            image =  tf.cast(tf.reshape(image,[self.image_height, self.image_width, 3]),tf.float32)
-            IR = tf.cast(tf.reshape(IR,[self.image_height, self.image_width, 3]),tf.float32)
+            image = self.decode_feature(features,'color',version)/255.0-0.5
+            IR = self.decode_feature(features,'IR',version)/255.0-0.5
             IR = tf.expand_dims(IR[:,:,0],axis=2)
-            depth = tf.cast(tf.reshape(depth,[self.image_height, self.image_width, 1]),tf.float32)
-            matK = tf.cast(tf.reshape(matK,[3,3]),tf.float32)
+            depth = self.decode_feature(features,'depth',version)
+            matK = self.decode_feature(features,'matK',version)
 
             if self.opt.downsample:
                 image = tf.image.resize_images(image,[224,224])
@@ -244,163 +369,728 @@ class DataLoader(object):
             data_dict['depth'] = depth
             data_dict['matK'] = matK
 
-            return data_dict
+            return self.rescale(data_dict)
 
 
         if not num_epochs:
             num_epochs = None
-        filenames = glob.glob(os.path.join(self.dataset_dir,'*.tfrecords'))
-
         with tf.name_scope('input_test'):
-            # TFRecordDataset opens a binary file and reads one record at a time.
-            # `filename` could also be a list of filenames, which will be read in order.
-            dataset = tf.data.TFRecordDataset(filenames)
-
-            # The map transformation takes a function and applies it to every element
-            # of the dataset.
-            dataset = dataset.map(decode)
+            if memmap_dataset.is_memmap_dataset(self.dataset_dir):
+                # Every epoch is a full permutation already, no shuffle buffer
+                dataset = self.memmap_source(num_epochs, set(['image', 'IR', 'depth', 'matK']), training=False)
+                buffer_size = 0
+            else:
+                filenames = self.record_files()
+                version, compression = record_io.detect_record_format(self.dataset_dir, filenames)
+                # Files are shuffled every epoch and read in parallel, the decoded
+                # examples come from the cache with --cache_dir
+                dataset = self.decoded_dataset(filenames, num_epochs, compression, decode,
+                                               {'version': version, 'features': 'test'},
+                                               num_parallel_calls=None)
+                buffer_size = self.shuffle_buffer_size(dataset, batch_size)
             # dataset = dataset.map(augment)
             # dataset = dataset.map(normalize)
 
-            # The shuffle transformation uses a finite-sized buffer to shuffle elements
-            # in memory. The parameter is the number of elements in the buffer. For
-            # completely uniform shuffling, set the parameter to be the same as the
-            # number of elements in the dataset.
-            dataset = dataset.shuffle(1000)#1000 + 3 * batch_size)
-            dataset = dataset.repeat(num_epochs)
+            # The shuffle buffer holds whole decoded examples, its size comes
+            # from the --shuffle_buffer_mb byte budget
+            self.log_pipeline_memory('inputs_test', element_bytes(dataset), buffer_size, batch_size)
+            if buffer_size > 1:
+                dataset = dataset.shuffle(buffer_size)
             dataset = dataset.batch(batch_size)
             iterator = dataset.make_one_shot_iterator()
 
         return iterator.get_next()
 
 
-    #================================
-    # Load rgb, depth, and mask through txt
-    #================================
-    def load_data_batch(self,split):
-
-        # Reads pfathes of images together with their labels
-        image_list,depth_list,label_list,ir_list,landmark_list = self.read_labeled_image_list(split)
-        steps_per_epoch = int(len(image_list)//self.batch_size)
-
-        #import pdb;pdb.set_trace()
-        images = tf.convert_to_tensor(image_list, dtype=tf.string)
-        depths = tf.convert_to_tensor(depth_list, dtype=tf.string)
-        labels = tf.convert_to_tensor(label_list, dtype=tf.string)
-        irs = tf.convert_to_tensor(ir_list, dtype=tf.string)
-        landmarks = tf.convert_to_tensor(landmark_list, dtype=tf.string)
-
-        # Makes an input queue
-        input_queue = tf.train.slice_input_producer([images,depths,labels,irs,landmarks], 
-                                                    num_epochs = 900,
-                                                    shuffle=True)
-
-        image,depth,label = self.read_images_from_disk(input_queue)
-
-        # Optional Image and Label Batching
-        image.set_shape((self.image_height, self.image_width, 3))
-        depth.set_shape([self.image_height, self.image_width, 1])
-        label.set_shape([self.image_height, self.image_width, 1])
-        image_batch, depth_batch, label_batch = tf.train.batch([image,depth,label],
-                                    num_threads = 8, batch_size=self.batch_size)
-
-        # Data augmentation
-        if split=='train':
-            image_batch, depth_batch, label_batch = self.data_augmentation(image_batch, depth_batch, label_batch,224,224)
-        
-        return image_batch, depth_batch, label_batch, steps_per_epoch
-
-
+    def shuffle_buffer_size(self, dataset, batch_size):
+        '''
+        Examples of dataset that fit in --shuffle_buffer_mb. With
+        --two_level_shuffle the file order is shuffled every epoch and the
+        buffer only mixes the interleaved files: cycle_length batches at most.
+        '''
+        budget = self.opt.shuffle_buffer_mb*(1<<20)
+        buffer_size = max(int(budget // element_bytes(dataset)), 1)
+        if self.opt.two_level_shuffle:
+            buffer_size = min(buffer_size, self.opt.cycle_length*batch_size)
+        return buffer_size
+
+    def log_pipeline_memory(self, name, example_bytes, buffer_size, batch_size):
+        '''
+        Print the host memory the examples held by a pipeline take: the
+        shuffle buffer and the batch being assembled
+        '''
+        held = (buffer_size+batch_size)*example_bytes
+        self.pipeline_bytes = held
+        print("%s holds %.1f MB: shuffle buffer %d x %.2f MB, batch %d (budget %.0f MB)" % (
+            name, held/float(1<<20), buffer_size, example_bytes/float(1<<20), batch_size, self.opt.shuffle_buffer_mb))
 
 
+    #==================================
+    # Load evaluation data from tf records
+    #==================================
 
-    #===================================
-    # Get file name list
-    #===================================
-
-    def read_labeled_image_list(self,split):
-        """Reads a .txt file containing pathes and labeles
-        Args:
-           image_list_file: a .txt file with one /path/to/image per line
-           label: optionally, if set label will be pasted after each line
-        Returns:
-           List with all filenames in file image_list_file
+    def inputs_eval(self,batch_size, num_epochs=1):
+        """Evaluation stream: num_epochs ordered passes over the dataset with
+        no augmentation and no shuffle, heatmaps rendered at the final sigma
+        after batching. With --cache_dir the decoded examples are cached
+        after the first pass. Every checkpoint evaluated on a dataset sees
+        the same batches.
+        With --roi_crop the window is centered on the ground-truth landmarks,
+        so the inputs carry ground truth a deployed model would not have:
+        the scores measure landmark accuracy given the board location.
         """
-        
-        f = open(self.dataset_dir+'/'+split+'.txt', 'r')
-        colorimages = []
-        depthimages = []
-        labelnames = []
-        irnames = []
-        landmarknames = []
-
-        
-
-        for line in f:
-
-            basepath = line[:-8]
-            name = line[-8:-1]
-
-            colorimage = basepath+'\\color\\'+name+'color.png.color.png'
-            colorimages.append(colorimage)
-
-            depthimage = line[:-1]+'depth1.png'
-            depthimages.append(depthimage)
+        def decode(serialized_example):
+            """Parses one record."""
+            return self.decode_record(serialized_example, version, rescale=not self.opt.roi_crop)
+
+        def crop(data_dict):
+            """Centered window around the landmarks, no jitter."""
+            return self.roi_crop(data_dict,self.image_height,self.image_width,False)
+
+        def render(data_dict):
+            """Renders the landmark heatmaps of a batch."""
+            roi_scale = data_dict.pop('roi_scale', None)
+            if 'points2D' in needed and 'points2D' not in data_dict:
+                data_dict['points2D'] = self.render_heatmaps(data_dict['pixel_coords'],
+                                                             data_dict['visibility'],
+                                                             self.heatmap_sigma(self.opt.change_gauss, roi_scale),
+                                                             self.image_height,
+                                                             self.image_width)
+            return data_dict
 
-            # irimage = line[:-1]+'ir.png'
-            # irnames.append(irimage)
-            
-            if split=='train' or split=='valid':
-                labelname = basepath+'\\mask\\'+name+'color.png.landmark_filtered.png'
-                labelnames.append(labelname)
-                #landmarkname = basepath+'\\landmark\\'+name+'landmark.txt'
-                #landmarknames.append(landmarkname)
-                
+        if not num_epochs:
+            num_epochs = None
+        if self.is_png_dataset():
+            raise ValueError('%s holds PNG folders, evaluation needs records' % self.dataset_dir)
+        needed = self.required_features()
+
+        with tf.name_scope('input_eval'):
+            if memmap_dataset.is_memmap_dataset(self.dataset_dir):
+                # Already a random-access copy, nothing to cache
+                dataset = self.memmap_source(num_epochs, self.decoded_features(True), shuffle=False,
+                                             rescale=not self.opt.roi_crop)
             else:
-                labelname = line[:-1]+'depth0.png'
-                labelnames.append(labelname)               
+                filenames = record_io.dataset_files(self.dataset_dir)
+                version, compression = record_io.detect_record_format(self.dataset_dir, filenames)
+                dataset = self.decoded_dataset(filenames, num_epochs, compression, decode,
+                                               {'version': version, 'features': sorted(needed)},
+                                               shuffle=False)
+            if self.opt.roi_crop:
+                dataset = dataset.map(crop,num_parallel_calls=8)
+            dataset = dataset.batch(batch_size)
+            dataset = dataset.map(render,num_parallel_calls=2)
+            dataset = dataset.prefetch(EVAL_PREFETCH)
 
-        return colorimages,depthimages,labelnames#,irnames,landmarknames
+        return dataset
 
 
-    def read_images_from_disk(self,input_queue):
-        """Consumes a single filename and label as a ' '-delimited string.
-        Args:
-          filename_and_label_tensor: A scalar string tensor.
-        Returns:
-          Two tensors: the decoded image, and the string label.
-        """
+    #==================================
+    # Read serialized records
+    #==================================
 
-        #import pdb;pdb.set_trace()
-        image_file = tf.read_file(input_queue[0])
-        depth_file = tf.read_file(input_queue[1])
-        label_file = tf.read_file(input_queue[2])
-        ir_file = tf.read_file(input_queue[3])
-        landmark_file = tf.read_file(input_queue[4])
+    def record_dataset(self, filenames, num_epochs, compression='NONE', shuffle=True):
+        '''
+        Serialized records of all files for num_epochs epochs. The file order
+        is reshuffled every epoch and --cycle_length files are read in
+        parallel with their records interleaved.
+        '''
+        compression_type = record_io.dataset_compression_type(compression)
+
+        def read_file(filename):
+            records = tf.data.TFRecordDataset(filename, compression_type=compression_type)
+            if self.record_shard is not None:
+                # Same records of a file for a worker in every epoch
+                records = records.shard(self.record_shard[1], self.record_shard[0])
+            return records
+
+        files = tf.data.Dataset.from_tensor_slices(filenames)
+        if shuffle:
+            files = files.shuffle(len(filenames))
+        files = files.repeat(num_epochs)
+        return files.apply(tf.contrib.data.parallel_interleave(
+                                read_file,
+                                cycle_length=self.opt.cycle_length,
+                                sloppy=shuffle))
+
+    def record_files(self, seekable=False):
+        '''
+        Record files of the dataset. In a producer process (see
+        shm_producer.py) the worker reads only its share of the files, or,
+        with fewer files than workers, its share of the records of every
+        file. Seekable sources read all files, sample_records splits their
+        records.
+        '''
+        filenames = record_io.dataset_files(self.dataset_dir)
+        self.record_shard = None
+        if self.worker_shard is not None and not seekable:
+            worker, num_workers = self.worker_shard
+            if len(filenames) >= num_workers:
+                filenames = filenames[worker::num_workers]
+            else:
+                self.record_shard = self.worker_shard
+        return filenames
+
+    def sample_records(self, num_records, training=True):
+        '''
+        Ids of the records a seekable source reads: for training, the records
+        with at least --min_visible visible landmarks (from the metadata
+        sidecar, see record_meta.py) and the --subset_size sample of them,
+        split between producer processes. Other streams keep every record.
+        '''
+        records = np.arange(num_records)
+        if self.opt.min_visible > 0 and training:
+            meta = record_meta.dataset_meta(self.dataset_dir)
+            records = np.flatnonzero(meta['num_visible'] >= self.opt.min_visible)
+            print("%d/%d records with at least %d visible landmarks" % (len(records), num_records, self.opt.min_visible))
+        if training:
+            records = records[record_index.subset_records(len(records), self.opt.subset_size, self.opt.shuffle_seed)]
+        if self.worker_shard is not None:
+            worker, num_workers = self.worker_shard
+            records = records[worker::num_workers]
+        if len(records) == 0:
+            # Raised here, the order generators only run inside tf.data
+            raise ValueError('no records left of the %d of %s after --min_visible=%d, --subset_size=%d and the producer split'
+                             % (num_records, self.dataset_dir, self.opt.min_visible if training else 0,
+                                self.opt.subset_size if training else 0))
+        self.num_records = len(records)
+        return records
+
+    def indexed_records(self, filenames, num_epochs, compression, shuffle=True):
+        '''
+        Serialized records read by offset (see record_index.py): a global
+        permutation per epoch from --shuffle_seed, the first --skip_records
+        records of the stream dropped and an optional --subset_size sample
+        '''
+        if compression != 'NONE':
+            raise ValueError('Reading records by offset needs uncompressed records, %s is %s' % (self.dataset_dir, compression))
+        index = record_index.RecordIndex(self.dataset_dir, filenames)
+        records = self.sample_records(index.num_records, training=shuffle)
+        return index.dataset(num_epochs,
+                             self.opt.shuffle_seed,
+                             records=records,
+                             skip=self.opt.skip_records,
+                             shuffle=shuffle,
+                             order=self.stream_order(records, num_epochs, self.opt.skip_records, shuffle))
+
+    def memmap_source(self, num_epochs, needed, shuffle=True, skip=0, rescale=True, training=True):
+        '''
+        data_dicts read from a memmap dataset (see memmap_dataset.py), in a
+        new permutation from --shuffle_seed every epoch, the first skip
+        examples of the stream dropped. Without rescale they stay at the
+        record resolution. Only shuffled training streams are filtered and
+        sampled (see sample_records and stream_order).
+        '''
+        source = memmap_dataset.MemmapDataset(self.dataset_dir)
+        keys = sorted(set([DATA_FEATURES[key] for key in needed]))
+        training = training and shuffle
+        records = self.sample_records(source.num_examples, training)
+
+        def read(index):
+            raw = source.tensors(index, keys)
+            return self.build_data_dict(lambda key: raw[key], needed, rescale)
+
+        dataset = tf.data.Dataset.from_generator(
+            self.stream_order(records, num_epochs, skip, shuffle, training),
+            tf.int64,
+            tf.TensorShape([]))
+        return dataset.map(read, num_parallel_calls=8)
+
+    def stream_order(self, records, num_epochs, skip, shuffle=True, training=None):
+        '''
+        Generator function of the record ids a seekable source reads: a
+        permutation of records per epoch (weighted draws with
+        --sample_weights, one frame per near-duplicate cluster with --dedup,
+        see dedup_records.py), or anchor/partner pairs of frames
+        sharing --pair_min_shared visible landmarks with --pair_sampling
+        (see pair_sampler.py). The samplers only apply to training streams,
+        by default the shuffled ones.
+        '''
+        if training is None:
+            training = shuffle
+        if self.opt.pair_sampling and training:
+            meta = record_meta.dataset_meta(self.dataset_dir)
+            # Pairs must come from one scene
+            record_meta.require_sequences(meta, '--pair_sampling')
+            return lambda: pair_sampler.pair_order(records,
+                                                   meta['visibility'],
+                                                   meta['sequence'],
+                                                   num_epochs,
+                                                   self.opt.shuffle_seed,
+                                                   self.opt.pair_min_shared,
+                                                   skip)
+        if self.opt.dedup and training:
+            cluster = dedup_records.load_clusters(self.dataset_dir)
+            # An epoch is one frame per cluster
+            self.num_records = len(np.unique(cluster[records]))
+            return lambda: dedup_records.cluster_order(records, cluster, num_epochs, self.opt.shuffle_seed, skip)
+        weights = None
+        if self.opt.sample_weights != "none" and training:
+            weights = record_meta.record_weights(record_meta.dataset_meta(self.dataset_dir), records, self.opt.sample_weights)
+        return lambda: record_index.record_order(records, num_epochs, self.opt.shuffle_seed, skip, shuffle, weights)
+
+    def prepare_sidecars(self):
+        '''
+        Load or build the record index and metadata the training stream
+        reads, and check the clusters of --dedup. shm_producer.py calls it
+        before forking, its daemonic workers cannot start scanning pools.
+        '''
+        memmap = memmap_dataset.is_memmap_dataset(self.dataset_dir)
+        if not memmap and not self.indexed_order():
+            return
+        if not memmap:
+            record_index.load_or_build_index(self.dataset_dir, record_io.dataset_files(self.dataset_dir))
+        if self.opt.min_visible > 0 or self.opt.pair_sampling or self.opt.sample_weights != "none":
+            record_meta.dataset_meta(self.dataset_dir)
+        if self.opt.dedup:
+            dedup_records.load_clusters(self.dataset_dir)
+
+    def check_pair_batch(self, batch_size):
+        if self.opt.pair_sampling and batch_size % 2 != 0:
+            raise ValueError('--pair_sampling needs an even batch size, got %d' % batch_size)
+
+    def resumable(self):
+        '''
+        True if the stream can start at --skip_records without reading the
+        records before it (memmap datasets, indexed records)
+        '''
+        return memmap_dataset.is_memmap_dataset(self.dataset_dir) or self.indexed_order()
+
+    def indexed_order(self):
+        '''
+        True if the records are read by offset in an order drawn by
+        stream_order (--global_shuffle, --pair_sampling, --dedup)
+        '''
+        return self.opt.global_shuffle or self.opt.pair_sampling or self.opt.dedup
+
+    def stream_mode(self):
+        '''
+        Options the record order depends on, a stream is resumed only with
+        the same ones
+        '''
+        return {'memmap': memmap_dataset.is_memmap_dataset(self.dataset_dir),
+                'global_shuffle': bool(self.opt.global_shuffle),
+                'pair_sampling': bool(self.opt.pair_sampling),
+                'dedup': bool(self.opt.dedup),
+                'min_visible': self.opt.min_visible,
+                'sample_weights': self.opt.sample_weights,
+                'num_producers': self.opt.num_producers}
+
+    def input_state(self, global_step, records):
+        '''
+        Position of the training stream after global_step batches and
+        records records, saved next to the checkpoints to resume with
+        --continue_train
+        '''
+        state = {'global_step': int(global_step),
+                 'records': int(records),
+                 'resumable': self.resumable(),
+                 'stream': self.stream_mode(),
+                 'shuffle_seed': self.opt.shuffle_seed,
+                 'subset_size': self.opt.subset_size}
+        if getattr(self, 'num_records', None):
+            state['epoch'] = records // self.num_records
+            state['position'] = records % self.num_records
+        return state
+
+    def decoded_dataset(self, filenames, num_epochs, compression, decode, cache_extra, num_parallel_calls=8, shuffle=True,
+                        version=None):
+        '''
+        Decoded examples for num_epochs epochs. With --cache_dir one ordered
+        pass is decoded into the cache (see data_cache.py) and repeated from
+        there; cache_extra holds whatever else the decode output depends on.
+        Without shuffle every epoch is in file and record order. Given the
+        record version (training streams only), records with fewer than
+        --min_visible visible landmarks are dropped before decoding.
+        '''
+        if self.opt.cache_dir == "None":
+            dataset = self.record_dataset(filenames, num_epochs, compression, shuffle)
+            if version is not None:
+                dataset = self.filter_visible(dataset, version)
+            return dataset.map(decode, num_parallel_calls=num_parallel_calls)
+
+        dataset = self.record_dataset(filenames, 1, compression, shuffle=False)
+        if version is not None and self.opt.min_visible > 0:
+            dataset = self.filter_visible(dataset, version)
+            cache_extra = dict(cache_extra, min_visible=self.opt.min_visible)
+        dataset = dataset.map(decode, num_parallel_calls=num_parallel_calls)
+        config = data_cache.cache_config(self.dataset_dir, filenames, self.opt, cache_extra)
+        dataset = data_cache.cached_dataset(dataset, self.opt.cache_dir, config, self.opt.cache_budget_gb)
+        return dataset.repeat(num_epochs)
+
+    def filter_visible(self, dataset, version):
+        '''
+        Drop the serialized records with fewer than --min_visible visible
+        landmarks, parsing only their visibility
+        '''
+        def enough_visible(serialized_example):
+            """Parses the visibility feature only."""
+            features = tf.parse_single_example(serialized_example,
+                                               features=record_io.record_features(version, ['visibility']))
+            visibility = tf.decode_raw(features['visibility'], tf.float32)
+            return tf.greater_equal(tf.reduce_sum(tf.to_int32(visibility > 0)), self.opt.min_visible)
 
+        if self.opt.min_visible > 0:
+            dataset = dataset.filter(enough_visible)
+        return dataset
 
-        image = tf.to_float(tf.image.resize_images(tf.image.decode_png(image_file),[224,224]))
 
-        depth = tf.to_float(tf.image.resize_images(tf.image.decode_png(depth_file,dtype=tf.uint16),[224,224]))
+    #==================================
+    # Decode a single record (v1 or v2 schema)
+    #==================================
 
-        label = tf.to_float(tf.image.resize_images(tf.image.decode_png(label_file),[224,224]))
+    def feature_shape(self, key, version):
+        '''
+        Natural shape of a record feature
+        '''
+        H = self.record_height
+        W = self.record_width
+        shapes = {
+            'color': [H, W, 3],
+            'IR': [H, W, 3] if version == record_io.RECORD_V1 else [H, W, 1],
+            'depth': [H, W, 1],
+            'mask': [H, W, 1],
+            'quaternion': [4],
+            'translation': [3],
+            'landmark_heatmap': [H, W, record_io.NUM_LANDMARKS],
+            'visibility': [record_io.NUM_LANDMARKS],
+            'matK': [3, 3],
+            'points2D': [2, record_io.NUM_LANDMARKS],
+        }
+        return shapes[key]
+
+    def decode_feature(self, features, key, version, batched=False):
+        '''
+        Decode one raw byte feature to a float32 tensor of its natural shape,
+        with a leading batch dimension if the features come from tf.parse_example
+        '''
+        dtype = tf.as_dtype(record_io.record_dtypes(version)[key])
+        value = tf.decode_raw(features[key], dtype)
+        shape = self.feature_shape(key, version)
+        if batched:
+            shape = [-1] + shape
+        return tf.cast(tf.reshape(value, shape), tf.float32)
+
+    def required_features(self):
+        '''
+        data_dict keys the run actually consumes, derived from the network
+        inputs, the model and the active losses
+        '''
+        opt = self.opt
+        needed = set(INPUT_FEATURES[opt.inputs])
+
+        if opt.evaluation:
+            # evaluate() fetches ground truth for every metric
+            return set(DATA_FEATURES)
+        if opt.model in ["multiscale", "hourglass"]:
+            needed |= set(['points2D'])
+        if opt.with_hm or opt.with_lmcoord:
+            needed |= set(['points2D', 'visibility'])
+        if opt.with_coordconv:
+            needed |= set(['pixel_coords'])
+        if opt.roi_crop:
+            # The crop window comes from the visible landmarks
+            needed |= set(['pixel_coords', 'visibility'])
+        if getattr(opt, 'with_4pcoordconv', False):
+            needed |= set(['pixel_coords', 'image'])
+        if opt.with_seg:
+            needed |= set(['label'])
+        if opt.with_vis:
+            needed |= set(['visibility'])
+        if opt.with_dist:
+            needed |= set(['points2D', 'depth', 'visibility', 'matK'])
+        if opt.with_pose:
+            needed |= set(['points2D', 'depth', 'visibility', 'matK', 'quaternion', 'translation', 'image'])
+        if opt.with_H:
+            needed |= set(['depth', 'visibility', 'quaternion', 'translation', 'image'])
+        if opt.with_DH:
+            needed |= set(['points2D', 'pixel_coords', 'image'])
+        if getattr(opt, 'pretrain_pose', False):
+            # The pose networks are pretrained on the ground truth heatmaps
+            needed |= set(['points2D', 'visibility'])
+            if opt.with_H:
+                # pose_estimate, not H_estimate
+                needed |= set(['points2D', 'depth', 'visibility', 'matK', 'quaternion', 'translation', 'image'])
+        if opt.proj_img:
+            needed |= set(['image', 'depth', 'matK'])
+        if opt.with_dom:
+            needed |= set(['IR', 'label'])
+        return needed
+
+    def decode_record(self, serialized_example, version, batched=False, rescale=True):
+        '''
+        Parse a record and build the data_dict consumed by the models and
+        compute_loss. Both schema versions give the same keys, shapes and
+        value ranges, except that 'points2D' is left out when the heatmaps
+        are to be rendered from the coordinates (v2 records, --render_hm).
+        Only the features in required_features() are parsed and decoded.
+        With batched=True, serialized_example is a vector of records parsed
+        with a single tf.parse_example and every op runs on the whole batch.
+        Without rescale the data_dict stays at the record resolution.
+        '''
+        render_hm = version == record_io.RECORD_V2 or self.opt.render_hm
+        needed = self.decoded_features(render_hm)
+
+        keys = set()
+        for key in needed:
+            keys.add(DATA_FEATURES[key])
+        if batched:
+            features = tf.parse_example(
+                serialized_example,
+                features=record_io.record_features(version, sorted(keys)))
+        else:
+            features = tf.parse_single_example(
+                serialized_example,
+                features=record_io.record_features(version, sorted(keys)))
+
+        def decode(key):
+            return self.decode_feature(features,key,version,batched)
+
+        return self.build_data_dict(decode, needed, rescale)
+
+    def decoded_features(self, render_hm):
+        '''
+        data_dict keys to decode, with the heatmaps replaced by the
+        coordinates they are rendered from if render_hm
+        '''
+        needed = self.required_features()
+        if 'points2D' in needed:
+            # Decoded from v1 records too, so v1 and v2 streams give the same
+            # keys (training.py switches between them with tf.cond)
+            needed |= set(['pixel_coords', 'visibility'])
+            if render_hm:
+                # The render stage builds the heatmaps from these
+                needed.remove('points2D')
+        return needed
+
+    def build_data_dict(self, decode, needed, rescale=True):
+        '''
+        Normalize the raw features into the data_dict keys in needed.
+        decode maps a record feature name to its float32 tensor.
+        '''
+        data_dict = {}
+        if 'image' in needed:
+            image = decode('color')/255.0-0.5
+            if self.opt.downsample:
+                image = tf.image.resize_images(image,[224,224])
+            data_dict['image'] = image
+        if 'IR' in needed:
+            IR = decode('IR')/255.0-0.5
+            IR = IR[...,0:1]
+            if self.opt.downsample:
+                IR = tf.image.resize_images(IR,[224,224])
+            data_dict['IR'] = IR
+        if 'depth' in needed:
+            data_dict['depth'] = decode('depth')
+        if 'label' in needed:
+            data_dict['label'] = decode('mask')/255.0
+        if 'quaternion' in needed:
+            data_dict['quaternion'] = decode('quaternion')
+        if 'translation' in needed:
+            translation = decode('translation')
+            norm = tf.sqrt(tf.reduce_sum(tf.square(translation),-1, keep_dims=True))
+            translation = translation / norm
+            data_dict['translation'] = tf.concat([translation,norm],axis=-1)
+        if 'visibility' in needed:
+            data_dict['visibility'] = decode('visibility')
+        if 'matK' in needed:
+            data_dict['matK'] = decode('matK')
+        if 'pixel_coords' in needed:
+            data_dict['pixel_coords'] = decode('points2D')
+        if 'points2D' in needed:
+            # Per-channel peak normalization, broadcast over HxW
+            points2D = decode('landmark_heatmap')
+            data_dict['points2D'] = points2D/(tf.reduce_max(points2D,[-3,-2],keep_dims=True)+0.0000001)
+
+        if not rescale:
+            return data_dict
+        return self.rescale(data_dict)
+
+    def rescale(self, data_dict):
+        '''
+        Resample the spatial modalities from the record resolution to
+        image_height x image_width and rescale pixel_coords and matK to match
+        (--record_height/--record_width). Works on examples and batches.
+        '''
+        if self.record_height == self.image_height and self.record_width == self.image_width:
+            return data_dict
+        size = [self.image_height, self.image_width]
+        sx = self.image_width/self.record_width
+        sy = self.image_height/self.record_height
+
+        for key in ['image','IR']:
+            # --downsample has already resized these
+            if key in data_dict and not self.opt.downsample:
+                data_dict[key] = tf.image.resize_images(data_dict[key],size)
+        for key in ['depth','label']:
+            if key in data_dict:
+                data_dict[key] = tf.image.resize_images(data_dict[key],size,
+                                                        method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+        if 'points2D' in data_dict:
+            points2D = tf.image.resize_images(data_dict['points2D'],size,method=tf.image.ResizeMethod.AREA)
+            data_dict['points2D'] = points2D/(tf.reduce_max(points2D,[-3,-2],keep_dims=True)+0.0000001)
+        if 'pixel_coords' in data_dict:
+            data_dict['pixel_coords'] = data_dict['pixel_coords']*tf.constant([[sx],[sy]])
+        if 'matK' in data_dict:
+            data_dict['matK'] = data_dict['matK']*tf.constant([[sx],[sy],[1.0]])
+        return data_dict
 
-        ir = tf.to_float(tf.image.resize_images(tf.image.decode_png(ir_file),[224,224]))
+    def schedule_step(self, batch):
+        '''
+        Training step of the batch-th batch of this stream. A producer
+        worker (see shm_producer.py) delivers every num_workers-th batch, its
+        batches are mapped to the global steps so the schedules advance as
+        in a single stream.
+        '''
+        if self.worker_shard is None:
+            return batch
+        worker, num_workers = self.worker_shard
+        return batch*num_workers+worker
+
+    def heatmap_sigma(self, step, roi_scale=None):
+        '''
+        Sigma of the rendered heatmaps at a training step. Decays
+        geometrically from --hm_sigma_start to --hm_sigma over --change_gauss
+        steps for coarse-to-fine training, constant if hm_sigma_start <= 0.
+        The sigmas are given at the record resolution and scaled to the
+        image, or with --roi_crop by the [B] magnification roi_scale of
+        every crop.
+        '''
+        if roi_scale is not None:
+            scale = roi_scale
+        else:
+            scale = self.image_width/self.record_width
+        if self.opt.hm_sigma_start <= 0 or self.opt.change_gauss <= 0:
+            return tf.cast(self.opt.hm_sigma*scale, tf.float32)
+        progress = tf.minimum(tf.to_float(step)/float(self.opt.change_gauss), 1.0)
+        return scale*self.opt.hm_sigma_start*tf.pow(self.opt.hm_sigma/self.opt.hm_sigma_start, progress)
+
+    def render_heatmaps(self, pixel_coords, visibility, sigma, height, width):
+        '''
+        Render landmark heatmaps as the outer product of two 1-D gaussians.
+        Args:
+            pixel_coords: [B]x2xD landmark pixel coordinates (x, y)
+            visibility: [B]xD visibility flags, invisible landmarks give empty maps
+            sigma: Gaussian sigma in pixels, one or [B]
+        Output:
+            A [B]xHxWxD 'Tensor' with every visible channel peaking at 1
+        '''
+        sigma = tf.cast(sigma, tf.float32)
+        if sigma.get_shape().ndims:
+            # Per-example sigmas broadcast over landmarks and pixels
+            sigma = tf.reshape(sigma, [-1,1,1])
+        xs = tf.range(width, dtype=tf.float32)
+        ys = tf.range(height, dtype=tf.float32)
+        # [B]xDxW and [B]xDxH 1-D gaussians
+        gx = tf.exp(-tf.square(xs-tf.expand_dims(pixel_coords[...,0,:],-1))/(2.0*sigma*sigma))
+        gy = tf.exp(-tf.square(ys-tf.expand_dims(pixel_coords[...,1,:],-1))/(2.0*sigma*sigma))
+
+        # The peak of an outer product is the product of the 1-D peaks
+        peak = tf.reduce_max(gx,-1)*tf.reduce_max(gy,-1)+0.0000001
+        weight = tf.clip_by_value(visibility,0.0,1.0)/peak
+        weight = tf.expand_dims(tf.expand_dims(weight,-2),-2)
+
+        rank = gx.get_shape().ndims
+        perm = list(range(rank-2))+[rank-1,rank-2]
+        heatmap = tf.expand_dims(tf.transpose(gy,perm),-2)*tf.expand_dims(tf.transpose(gx,perm),-3)
+        return heatmap*weight
 
-        #record_defaults = [[0.0]]*
-        #proj_landmark_vis = 
 
-        image = image/255.0
+    #================================
+    # Load rgb, depth, IR and mask from PNG capture folders
+    #================================
+    def is_png_dataset(self):
+        '''
+        A capture folder with a <split>.txt frame list and no tfrecords
+        '''
+        return (os.path.exists(os.path.join(self.dataset_dir, self.split+'.txt')) and
+                not memmap_dataset.is_memmap_dataset(self.dataset_dir) and
+                len(record_io.dataset_files(self.dataset_dir)) == 0)
+
+    def inputs_png(self,batch_size, num_epochs,with_aug=False):
+        """tf.data pipeline over the PNG capture folders: parallel read_file
+        and decode_png of the modalities the run needs only, at their native
+        resolution, with the same data_dict normalization as the records.
+        With --cache_dir the decoded frames are cached.
+        """
+        def decode(*files):
+            """Decodes the PNG files of one frame."""
+            raw = {}
+            for key, contents in zip(keys, files):
+                feature = DATA_FEATURES[key]
+                dtype, channels = PNG_FORMATS[feature]
+                value = tf.image.decode_png(contents, channels=channels, dtype=dtype)
+                value.set_shape(self.feature_shape(feature, record_io.RECORD_V2))
+                raw[feature] = tf.to_float(value)
+            return self.build_data_dict(lambda feature: raw[feature], needed)
+
+        def read(*paths):
+            return tuple([tf.read_file(path) for path in paths])
 
-        depth = depth/1600.0
+        def augment2(data_dict):
+            return self.data_augmentation2(data_dict,self.image_height,self.image_width)
 
-        label = tf.expand_dims(label[:,:,0],2)
+        if not num_epochs:
+            num_epochs = None
+        needed = self.required_features()
+        missing = needed - set(PNG_FEATURES)
+        if len(missing) > 0:
+            raise ValueError('%s are not stored in the PNG folders of %s' % (sorted(missing), self.dataset_dir))
+        keys = sorted(needed)
+        paths = self.read_labeled_image_list(self.split)
+        num_frames = len(paths[keys[0]])
+
+        with tf.name_scope('input_png'):
+            dataset = tf.data.Dataset.from_tensor_slices(tuple([paths[key] for key in keys]))
+            if self.opt.cache_dir == "None":
+                # Shuffling paths is free, the whole list is permuted
+                dataset = dataset.shuffle(num_frames)
+                dataset = dataset.repeat(num_epochs)
+                dataset = dataset.map(read,num_parallel_calls=8)
+                dataset = dataset.map(decode,num_parallel_calls=8)
+            else:
+                dataset = dataset.map(read,num_parallel_calls=8)
+                dataset = dataset.map(decode,num_parallel_calls=8)
+                # The frame list stands in for the files in the content hash
+                config = data_cache.cache_config(self.dataset_dir,
+                                                 [os.path.join(self.dataset_dir, self.split+'.txt')],
+                                                 self.opt,
+                                                 {'format': 'png', 'features': keys})
+                dataset = data_cache.cached_dataset(dataset, self.opt.cache_dir, config, self.opt.cache_budget_gb)
+                dataset = dataset.shuffle(100)
+                dataset = dataset.repeat(num_epochs)
+            if with_aug:
+                dataset = dataset.map(augment2,num_parallel_calls=8)
+            dataset = dataset.batch(batch_size)
+            dataset = dataset.prefetch(1)
 
-        label = label/255.0
+        return dataset
 
-        ir = ir/255.0
+    #===================================
+    # Get file name list
+    #===================================
 
-        return image, depth, label
+    def read_labeled_image_list(self,split):
+        """Reads the <split>.txt list of frame prefixes of a capture folder
+        Args:
+           split: train, valid or test
+        Returns:
+           {data_dict key: list of PNG paths} for image, depth, label and IR
+        """
+        paths = {'image': [], 'depth': [], 'label': [], 'IR': []}
+        with open(os.path.join(self.dataset_dir, split+'.txt'), 'r') as f:
+            for line in f:
+                prefix = line.rstrip('\r\n')
+                if prefix == '':
+                    continue
+                files = build_manifest.frame_files(prefix)
+                for key in ['image', 'depth', 'IR']:
+                    paths[key].append(files[key])
+                if split=='train' or split=='valid':
+                    paths['label'].append(files['label'])
+                else:
+                    paths['label'].append(files['depth0'])
+
+        return paths
 
 
     def data_augmentation(self, ir, image, depth, label, landmark,matK, out_h, out_w):
@@ -503,30 +1193,8 @@ class DataLoader(object):
             return ir,image, depth, label,landmark,matK
 
         def random_color(image):
-
-            color_ordering = scaling = tf.random_uniform([1], 0, 4,dtype=tf.int32)
-            
-            image = tf.cond(tf.equal(color_ordering[0],tf.zeros([],tf.int32)),lambda:tf.image.random_brightness(image, max_delta=32. / 255.),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.zeros([],tf.int32)),lambda:tf.image.random_saturation(image, lower=0.5, upper=1.5),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.zeros([],tf.int32)),lambda:tf.image.random_hue(image, max_delta=0.2),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.zeros([],tf.int32)),lambda:tf.image.random_contrast(image, lower=0.5, upper=1.5),lambda:image)
-
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)),lambda:tf.image.random_saturation(image, lower=0.5, upper=1.5),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)),lambda:tf.image.random_brightness(image, max_delta=32. / 255.),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)),lambda:tf.image.random_contrast(image, lower=0.5, upper=1.5),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)),lambda:tf.image.random_hue(image, max_delta=0.2),lambda:image)
-
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*2),lambda:tf.image.random_contrast(image, lower=0.5, upper=1.5),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*2),lambda:tf.image.random_hue(image, max_delta=0.2),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*2),lambda:tf.image.random_brightness(image, max_delta=32. / 255.),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*2),lambda:tf.image.random_saturation(image, lower=0.5, upper=1.5),lambda:image)
-
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*3),lambda:tf.image.random_hue(image, max_delta=0.2),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*3),lambda:tf.image.random_saturation(image, lower=0.5, upper=1.5),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*3),lambda:tf.image.random_contrast(image, lower=0.5, upper=1.5),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*3),lambda:tf.image.random_brightness(image, max_delta=32. / 255.),lambda:image) 
-
-            return image
+            # Per-example parameters, no branching (see color_jitter)
+            return self.color_jitter(image)
 
         def do_color(ir, image, depth, label,landmark):
             image = random_color(image)
@@ -547,95 +1215,204 @@ class DataLoader(object):
 
     def data_augmentation2(self, data_dict, out_h, out_w):
 
-        def random_rotate(data_dict):
-            #import pdb;pdb.set_trace()
-            angle = tf.random_uniform([1], -np.pi/5.0, np.pi/5.0, dtype=tf.float32)[0]
-            data_dict['IR'] = tf.contrib.image.rotate(data_dict['IR'],angle)
-            data_dict['image'] = tf.contrib.image.rotate(data_dict['image'],angle)
-            data_dict['points2D'] = tf.contrib.image.rotate(data_dict['points2D'],angle)
-            center = tf.tile(tf.expand_dims(tf.stack([tf.to_float(self.image_width/2.0),tf.to_float(self.image_height/2.0)]),axis=1),[1,data_dict['pixel_coords'].get_shape()[1]])
-            temppoint = data_dict['pixel_coords']-center
-            temppoint = utlr.rotate(temppoint, -angle)
-            data_dict['pixel_coords'] = temppoint+center
-            return data_dict
-
-        
-        # Random scaling
-        def random_scaling(data_dict):
-            in_h, in_w, _ = data_dict['IR'].get_shape().as_list()
-            scaling = tf.random_uniform([2], 1, 1.15)
-            x_scaling = scaling[0]
-            y_scaling = scaling[1]
-            out_h = tf.cast(in_h * y_scaling, dtype=tf.int32)
-            out_w = tf.cast(in_w * x_scaling, dtype=tf.int32)
-
-            data_dict['IR'] = tf.image.resize_images(data_dict['IR'], [out_h, out_w])
-            data_dict['image'] = tf.image.resize_images(data_dict['image'], [out_h, out_w])
-            data_dict['points2D'] = tf.image.resize_images(data_dict['points2D'], [out_h, out_w])
+        keys = [key for key in ['IR','image','points2D','depth','label'] if key in data_dict]
+        if len(keys) == 0:
             return data_dict
 
+        in_h, in_w, _ = data_dict[keys[0]].get_shape().as_list()
+        A = self.random_affine(in_h, in_w, out_h, out_w)
+        data_dict = self.warp_data_dict(data_dict, A, out_h, out_w)
 
+        if self.opt.color_jitter == "example":
+            data_dict = self.jitter_colors(data_dict)
 
-        # Random cropping
-        def random_cropping(data_dict):
-
-            # batch_size, in_h, in_w, _ = im.get_shape().as_list()
-            in_h, in_w, _ = tf.unstack(tf.shape(data_dict['IR']))
-            offset_y = tf.random_uniform([1], 0, in_h - out_h + 1, dtype=tf.int32)[0]
-            offset_x = tf.random_uniform([1], 0, in_w - out_w + 1, dtype=tf.int32)[0]
-
-            _in_h = tf.to_float(in_h)
-            _in_w = tf.to_float(in_w)
-            _out_h = tf.to_float(out_h)
-            _out_w = tf.to_float(out_w)
-
-            ratio = tf.tile(tf.expand_dims(tf.stack([tf.to_float(_in_w/_out_w),tf.to_float(_in_h/_out_h)]),axis=1),[1,data_dict['pixel_coords'].get_shape()[1]])
-            offsets = tf.tile(tf.expand_dims(tf.stack([tf.to_float(offset_x),tf.to_float(offset_y)]),axis=1),[1,data_dict['pixel_coords'].get_shape()[1]])
-
-            data_dict['pixel_coords'] = data_dict['pixel_coords']*ratio-offsets
-
-            data_dict['IR'] = tf.image.crop_to_bounding_box(
-                data_dict['IR'], offset_y, offset_x, out_h, out_w)
-            data_dict['image'] = tf.image.crop_to_bounding_box(
-                data_dict['image'], offset_y, offset_x, out_h, out_w)
-            data_dict['points2D'] = tf.image.crop_to_bounding_box(
-                data_dict['points2D'], offset_y, offset_x, out_h, out_w)
-            return data_dict
-
-
-        def random_color(image):
-
-            color_ordering = tf.random_uniform([1], 0, 4,dtype=tf.int32)
-            
-            image = tf.cond(tf.equal(color_ordering[0],tf.zeros([],tf.int32)),lambda:tf.image.random_brightness(image, max_delta=32. / 255.),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.zeros([],tf.int32)),lambda:tf.image.random_saturation(image, lower=0.5, upper=1.5),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.zeros([],tf.int32)),lambda:tf.image.random_hue(image, max_delta=0.2),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.zeros([],tf.int32)),lambda:tf.image.random_contrast(image, lower=0.5, upper=1.5),lambda:image)
-
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)),lambda:tf.image.random_saturation(image, lower=0.5, upper=1.5),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)),lambda:tf.image.random_brightness(image, max_delta=32. / 255.),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)),lambda:tf.image.random_contrast(image, lower=0.5, upper=1.5),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)),lambda:tf.image.random_hue(image, max_delta=0.2),lambda:image)
-
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*2),lambda:tf.image.random_contrast(image, lower=0.5, upper=1.5),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*2),lambda:tf.image.random_hue(image, max_delta=0.2),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*2),lambda:tf.image.random_brightness(image, max_delta=32. / 255.),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*2),lambda:tf.image.random_saturation(image, lower=0.5, upper=1.5),lambda:image)
-
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*3),lambda:tf.image.random_hue(image, max_delta=0.2),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*3),lambda:tf.image.random_saturation(image, lower=0.5, upper=1.5),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*3),lambda:tf.image.random_contrast(image, lower=0.5, upper=1.5),lambda:image)
-            image = tf.cond(tf.equal(color_ordering[0],tf.ones([],tf.int32)*3),lambda:tf.image.random_brightness(image, max_delta=32. / 255.),lambda:image) 
+        return data_dict
 
-            return image
+    def warp_data_dict(self, data_dict, A, out_h, out_w):
+        '''
+        Resample the image modalities of data_dict to out_h x out_w with A
+        (input to output pixels) and map pixel_coords and matK with it
+        '''
+        # Only the modalities the run decoded are warped; depth and label
+        # are resampled with NEAREST so no values are invented at edges
+        keys = [key for key in ['IR','image','points2D'] if key in data_dict]
+        nearest_keys = [key for key in ['depth','label'] if key in data_dict]
+
+        # One resampling pass per modality
+        for key in keys:
+            data_dict[key] = self.affine_warp(data_dict[key], A, out_h, out_w, 'BILINEAR')
+        for key in nearest_keys:
+            data_dict[key] = self.affine_warp(data_dict[key], A, out_h, out_w, 'NEAREST')
+
+        # Same matrix for the geometry
+        if 'pixel_coords' in data_dict:
+            data_dict['pixel_coords'] = tf.matmul(A[0:2,0:2],data_dict['pixel_coords'])+A[0:2,2:3]
+        if 'matK' in data_dict:
+            data_dict['matK'] = tf.matmul(A,data_dict['matK'])
 
+        return data_dict
 
-                
-        data_dict=random_rotate(data_dict)
-        data_dict=random_scaling(data_dict)
-        data_dict=random_cropping(data_dict)
-        #data_dict['IR'] = random_color(data_dict['IR'])
+    #==================================
+    # Board-centric ROI crop
+    #==================================
+    # With --roi_crop the examples are decoded at the record resolution and
+    # a window around the visible landmarks is resampled to img_height x
+    # img_width in one warp, so the board keeps its full resolution instead
+    # of being downscaled with the whole frame. Training jitters the window
+    # and rotates it; evaluation takes the centered window.
+
+    def roi_crop(self, data_dict, out_h, out_w, jitter):
+        '''
+        Crop the window of roi_affine around the landmarks of a single
+        example to out_h x out_w
+        '''
+        if self.opt.downsample:
+            raise ValueError('--roi_crop resamples from the record resolution, it cannot be used with --downsample')
+        in_h = self.record_height
+        in_w = self.record_width
+        A = self.roi_affine(data_dict['pixel_coords'], data_dict['visibility'], in_h, in_w, out_h, out_w, jitter)
+        data_dict = self.warp_data_dict(data_dict, A, out_h, out_w)
+        # Magnification of the window, the heatmap sigma follows it
+        data_dict['roi_scale'] = tf.sqrt(tf.abs(tf.matrix_determinant(A[0:2,0:2])))
+
+        if jitter and self.opt.color_jitter == "example":
+            data_dict = self.jitter_colors(data_dict)
 
         return data_dict
 
+    def roi_affine(self, pixel_coords, visibility, in_h, in_w, out_h, out_w, jitter):
+        '''
+        3x3 matrix mapping input pixels to an out_h x out_w window around
+        the visible landmarks, widened by --roi_margin on every side (the
+        whole frame if none is visible). With jitter the input is rotated
+        first and the window size and center are perturbed by --roi_jitter.
+        Args:
+            pixel_coords: [2,28] landmark pixel coordinates
+            visibility: [28] landmark visibility flags
+        '''
+        if jitter:
+            # Rotating first and bounding the rotated landmarks keeps the
+            # whole board inside the window
+            rotate = self.random_rotation(in_h, in_w)
+            pixel_coords = tf.matmul(rotate[0:2,0:2],pixel_coords)+rotate[0:2,2:3]
+        else:
+            rotate = tf.eye(3)
+
+        visible = tf.reshape(visibility,[-1]) > 0
+        any_visible = tf.reduce_any(visible)
+        x = pixel_coords[0]
+        y = pixel_coords[1]
+        far = 1e6*tf.ones_like(x)
+        x0 = tf.where(any_visible, tf.reduce_min(tf.where(visible, x, far)), 0.0)
+        y0 = tf.where(any_visible, tf.reduce_min(tf.where(visible, y, far)), 0.0)
+        x1 = tf.where(any_visible, tf.reduce_max(tf.where(visible, x, -far)), in_w-1.0)
+        y1 = tf.where(any_visible, tf.reduce_max(tf.where(visible, y, -far)), in_h-1.0)
+
+        # Window with the aspect ratio of the output, at least 16 pixels wide
+        cx = (x0+x1)/2.0
+        cy = (y0+y1)/2.0
+        width = tf.maximum(tf.maximum(x1-x0, (y1-y0)*out_w/out_h)*(1.0+2.0*self.opt.roi_margin), 16.0)
+        if jitter:
+            width = width*tf.random_uniform([], 1.0-self.opt.roi_jitter, 1.0+self.opt.roi_jitter)
+            cx = cx+width*tf.random_uniform([], -self.opt.roi_jitter, self.opt.roi_jitter)
+            cy = cy+width*out_h/out_w*tf.random_uniform([], -self.opt.roi_jitter, self.opt.roi_jitter)
+
+        scale = out_w/width
+        crop = tf.stack([[scale, 0.0, (out_w-1)/2.0-scale*cx],
+                         [0.0, scale, (out_h-1)/2.0-scale*cy],
+                         [0.0, 0.0, 1.0]])
+
+        return tf.matmul(crop, rotate)
+
+    def jitter_colors(self, data_dict):
+        '''
+        color_jitter on image and IR, single examples or whole batches
+        '''
+        for key in ['image','IR']:
+            if key in data_dict:
+                data_dict[key] = self.color_jitter(data_dict[key])
+        return data_dict
 
+    def color_jitter(self, images):
+        '''
+        Random brightness, saturation, hue and contrast with the parameters
+        drawn per example as tensors, applied with one set of ops to the
+        whole batch.
+        Args:
+            images: [B,H,W,C] or [H,W,C] in [-0.5,0.5]; C is 3 (color) or
+                    1 (IR: brightness and contrast only)
+        '''
+        single = images.get_shape().ndims == 3
+        if single:
+            images = tf.expand_dims(images,0)
+        batch = tf.shape(images)[0]
+        channels = images.get_shape()[-1].value
+
+        def per_example(lower, upper):
+            return tf.random_uniform(tf.stack([batch,1,1,1]), lower, upper)
+
+        x = images+0.5
+        x = x+per_example(-32./255., 32./255.)
+        if channels == 3:
+            gray = tf.reduce_sum(x*tf.constant([0.299,0.587,0.114]),-1,keep_dims=True)
+            x = gray+(x-gray)*per_example(0.5, 1.5)
+            hsv = tf.image.rgb_to_hsv(tf.clip_by_value(x,0.0,1.0))
+            hue = tf.mod(hsv[...,0:1]+per_example(-0.2, 0.2), 1.0)
+            x = tf.image.hsv_to_rgb(tf.concat([hue,hsv[...,1:]],axis=-1))
+        mean = tf.reduce_mean(x,[1,2],keep_dims=True)
+        x = mean+(x-mean)*per_example(0.5, 1.5)
+        images = tf.clip_by_value(x,0.0,1.0)-0.5
+
+        if single:
+            images = images[0]
+        return images
+
+    def random_affine(self, in_h, in_w, out_h, out_w):
+        '''
+        Random rotation about the image center, scaling and crop composed
+        into one 3x3 matrix mapping input pixel coordinates to output ones
+        '''
+        rotate = self.random_rotation(in_h, in_w)
+
+        # Scaling by 1 to 1.15 per axis
+        scaling = tf.random_uniform([2], 1, 1.15)
+        scale = tf.stack([[scaling[0], 0.0, 0.0],
+                          [0.0, scaling[1], 0.0],
+                          [0.0, 0.0, 1.0]])
+
+        # Crop of out_h x out_w anywhere inside the scaled image
+        offset_x = tf.random_uniform([], 0.0, 1.0)*tf.maximum(in_w*scaling[0]-out_w, 0.0)
+        offset_y = tf.random_uniform([], 0.0, 1.0)*tf.maximum(in_h*scaling[1]-out_h, 0.0)
+        crop = tf.stack([[1.0, 0.0, -offset_x],
+                         [0.0, 1.0, -offset_y],
+                         [0.0, 0.0, 1.0]])
+
+        return tf.matmul(crop, tf.matmul(scale, rotate))
+
+    def random_rotation(self, in_h, in_w):
+        '''
+        Rotation by up to pi/5 about the image center as a 3x3 matrix
+        (same sense as tf.contrib.image.rotate)
+        '''
+        angle = tf.random_uniform([], -np.pi/5.0, np.pi/5.0, dtype=tf.float32)
+        cx = (in_w-1)/2.0
+        cy = (in_h-1)/2.0
+        cos = tf.cos(angle)
+        sin = tf.sin(angle)
+        return tf.stack([[cos, sin, cx-cos*cx-sin*cy],
+                         [-sin, cos, cy+sin*cx-cos*cy],
+                         [0.0, 0.0, 1.0]])
+
+    def affine_warp(self, image, A, out_h, out_w, interpolation):
+        '''
+        Resample image (HxWxC) with the affine map A of random_affine
+        '''
+        # transform() maps output pixels back to input pixels
+        A_inv = tf.matrix_inverse(A)
+        transform = tf.reshape(A_inv/A_inv[2,2],[9])[0:8]
+        warped = tf.contrib.image.transform(image,
+                                            transform,
+                                            interpolation=interpolation,
+                                            output_shape=[out_h,out_w])
+        warped.set_shape([out_h,out_w,image.get_shape()[-1]])
+        return warped
@@ -0,0 +1,193 @@
+from __future__ import division
+import tensorflow as tf
+import numpy as np
+import cv2
+import os
+import record_io
+import build_manifest
+import record_meta
+import memmap_dataset
+
+#==================================
+# Near-duplicate frame clusters
+#==================================
+# The captures are video, consecutive frames are nearly identical. Every
+# frame gets a 64-bit difference hash of its IR image; walking each
+# sequence in frame order, a frame joins the current cluster if its hash is
+# within max_hamming bits of the cluster's first frame, it sees the same
+# landmarks and none of them moved more than max_shift pixels. Otherwise
+# it starts a new cluster. record_clusters.npz holds the cluster of every
+# record (indexed like the record index); with --dedup the loader draws one
+# frame per cluster per epoch (cluster_order).
+
+CLUSTERS_NAME = 'record_clusters.npz'
+HASH_SIZE = 8
+
+
+def dhash(IR):
+    '''
+    Difference hash of an IR image: signs of the horizontal gradients of
+    a (HASH_SIZE)x(HASH_SIZE+1) thumbnail, packed in HASH_SIZE bytes
+    '''
+    thumbnail = cv2.resize(IR.astype(np.float32), (HASH_SIZE+1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    return np.packbits(thumbnail[:, 1:] > thumbnail[:, :-1])
+
+
+def frame_signature(IR, points2D, visibility):
+    return {'hash': dhash(IR),
+            'points2D': points2D.reshape([2, record_io.NUM_LANDMARKS]).astype(np.float32),
+            'visible': visibility.reshape([-1]) > 0}
+
+
+def scan_file(args):
+    '''
+    frame_signature() of every record of one file
+    '''
+    filename, compression, image_height, image_width = args
+    frames = []
+    for serialized in tf.python_io.tf_record_iterator(filename, record_io.record_options(compression)):
+        arrays = record_io.parse_example_numpy(serialized)
+        # v1 IR is 3-channel float, v2 single-channel uint8
+        IR = arrays['IR'].reshape([image_height, image_width, -1])[:, :, 0]
+        frames.append(frame_signature(IR, arrays['points2D'], arrays['visibility']))
+    return frames
+
+
+def scan_records(filenames, compression, image_height, image_width, num_workers=8):
+    frames = []
+    jobs = [(filename, compression, image_height, image_width) for filename in filenames]
+    for filename, file_frames in zip(filenames, record_meta.imap_jobs(scan_file, jobs, num_workers)):
+        frames += file_frames
+        print("Hashed %s (%d records)" % (filename, len(frames)))
+    return frames
+
+
+def scan_memmap(dataset_dir):
+    source = memmap_dataset.MemmapDataset(dataset_dir)
+    frames = []
+    for i in range(source.num_examples):
+        IR, points2D, visibility = source.read(i, ['IR', 'points2D', 'visibility'])
+        frames.append(frame_signature(IR[:, :, 0], points2D, visibility))
+    return frames
+
+
+def is_duplicate(frame, first, max_hamming, max_shift):
+    '''
+    True if frame is a near-duplicate of the first frame of a cluster
+    '''
+    if np.unpackbits(frame['hash'] ^ first['hash']).sum() > max_hamming:
+        return False
+    if not np.array_equal(frame['visible'], first['visible']):
+        return False
+    if not frame['visible'].any():
+        return True
+    shift = frame['points2D'][:, frame['visible']]-first['points2D'][:, first['visible']]
+    return np.sqrt((shift**2).sum(0)).max() <= max_shift
+
+
+def cluster_frames(frames, sequence, order, max_hamming=6, max_shift=2.0):
+    '''
+    Cluster id of every record
+    Args:
+        frames: frame_signature() of every record
+        sequence: [N] sequence id of every record
+        order: Record ids in frame order
+    '''
+    cluster = np.zeros(len(frames), dtype=np.int32)
+    num_clusters = 0
+    first = None
+    for record in order:
+        if (first is None or sequence[record] != sequence[first] or
+                not is_duplicate(frames[record], frames[first], max_hamming, max_shift)):
+            first = record
+            num_clusters += 1
+        cluster[record] = num_clusters-1
+    return cluster
+
+
+def build_clusters(dataset_dir, image_height, image_width, max_hamming=6, max_shift=2.0, num_workers=8):
+    '''
+    Cluster the records of a tfrecords or memmap dataset and write
+    record_clusters.npz
+    '''
+    names, sizes = record_meta.dataset_key(dataset_dir)
+    if memmap_dataset.is_memmap_dataset(dataset_dir):
+        frames = scan_memmap(dataset_dir)
+    else:
+        filenames = record_io.dataset_files(dataset_dir)
+        _, compression = record_io.detect_record_format(dataset_dir, filenames)
+        frames = scan_records(filenames, compression, image_height, image_width, num_workers)
+
+    sequence, _ = record_meta.sequence_ids(dataset_dir, len(frames))
+    prefixes = record_meta.frame_names(dataset_dir, len(frames))
+    if prefixes is None:
+        # Records in stored order
+        order = np.arange(len(frames))
+    else:
+        # Frame numbers compared as numbers, unpadded ones stay in capture order
+        order = np.array(sorted(range(len(prefixes)), key=lambda i: build_manifest.frame_sort_key(prefixes[i])),
+                         dtype=np.int64)
+    cluster = cluster_frames(frames, sequence, order, max_hamming, max_shift)
+
+    clusters = {'cluster': cluster,
+                'max_hamming': max_hamming,
+                'max_shift': max_shift,
+                'files': np.array(names),
+                'sizes': np.array(sizes, dtype=np.int64)}
+    np.savez(os.path.join(dataset_dir, CLUSTERS_NAME), **clusters)
+    print("%d records in %d clusters" % (len(cluster), cluster.max()+1 if len(cluster) else 0))
+    return clusters
+
+
+def load_clusters(dataset_dir):
+    '''
+    Cluster id of every record, from record_clusters.npz
+    '''
+    path = os.path.join(dataset_dir, CLUSTERS_NAME)
+    if not os.path.exists(path):
+        raise ValueError('no %s in %s, run dedup_records.py first' % (CLUSTERS_NAME, dataset_dir))
+    clusters = dict(np.load(path))
+    names, sizes = record_meta.dataset_key(dataset_dir)
+    if list(clusters['files']) != names or list(clusters['sizes']) != sizes:
+        raise ValueError('%s is out of date, run dedup_records.py again' % path)
+    return clusters['cluster']
+
+
+def cluster_order(records, cluster, num_epochs, seed, skip=0):
+    '''
+    Ids of num_epochs epochs (None: forever) of one random member of every
+    cluster of records, the clusters in a permutation drawn from
+    (seed, epoch). The first skip ids of the stream are dropped without
+    reading anything.
+    '''
+    records = np.asarray(records)
+    if len(records) == 0:
+        raise ValueError('no records to cluster, --min_visible or --subset_size filtered out every record')
+    # Members of every cluster, as positions in records
+    ids, inverse = np.unique(cluster[records], return_inverse=True)
+    members = [[] for _ in ids]
+    for position, c in enumerate(inverse):
+        members[c].append(position)
+
+    epoch = skip // len(members)
+    position = skip % len(members)
+    while num_epochs is None or epoch < num_epochs:
+        rng = np.random.RandomState([seed, epoch])
+        picks = [group[rng.randint(len(group))] for group in members]
+        for c in rng.permutation(len(members))[position:]:
+            yield records[picks[c]]
+        position = 0
+        epoch += 1
+
+
+if __name__ == "__main__":
+    flags = tf.app.flags
+    flags.DEFINE_string("dataset_dir", "/home/z003xr2y/data/data/tfrecords_hr_filldepth_v2/", "tfrecords or memmap dataset")
+    flags.DEFINE_integer("img_height", 480, "Image height")
+    flags.DEFINE_integer("img_width", 640, "Image width")
+    flags.DEFINE_integer("max_hamming", 6, "Largest IR hash distance (of 64 bits) within a cluster")
+    flags.DEFINE_float("max_shift", 2.0, "Largest landmark displacement (pixels) within a cluster")
+    flags.DEFINE_integer("num_workers", 8, "Number of hashing processes")
+    opt = flags.FLAGS
+
+    build_clusters(opt.dataset_dir, opt.img_height, opt.img_width, opt.max_hamming, opt.max_shift, opt.num_workers)
@@ -1,16 +1,21 @@
 import tensorflow as tf
 import numpy as np
 from data_loader_direct import DataLoader
+import record_io
+from shm_producer import producer_dataset
 from my_losses import *
 from model import *
 import time
 import math
-import os
+import os, glob
+import json
 from smoother import Smoother
 import cv2
 from collections import OrderedDict
 
 
+INPUT_STATE_SUFFIX = '.input_state.json'
+
 PS_OPS = [
     'Variable', 'VariableV2', 'AutoReloadVariable', 'MutableHashTable',
     'MutableHashTableOfTensors', 'MutableDenseHashTable'
@@ -107,20 +112,38 @@ def collect_vars(scope, start=None, end=None, prepend_scope=None):
 
 
 
-def save(sess, checkpoint_dir, step, saver):
+def save(sess, checkpoint_dir, step, saver, input_state=None):
     '''
-    Save checkpoints
+    Save checkpoints, and the input stream position next to them
     '''
     model_name = 'model'
     print(" [*] Saving checkpoint to %s..." % checkpoint_dir)
     if step == 'latest':
-        saver.save(sess, 
+        checkpoint = saver.save(sess, 
                         os.path.join(checkpoint_dir, model_name + '.latest'))
     else:
-        saver.save(sess, 
+        checkpoint = saver.save(sess, 
                         os.path.join(checkpoint_dir, model_name),
                         global_step=step)
 
+    if input_state is not None:
+        with open(checkpoint + INPUT_STATE_SUFFIX, 'w') as f:
+            json.dump(input_state, f, indent=2)
+        # Drop the states of checkpoints the saver has deleted
+        for state_file in glob.glob(os.path.join(checkpoint_dir, '*' + INPUT_STATE_SUFFIX)):
+            if not os.path.exists(state_file[:-len(INPUT_STATE_SUFFIX)] + '.index'):
+                os.remove(state_file)
+
+
+def load_input_state(checkpoint):
+    '''
+    Input stream position saved with a checkpoint, None if there is none
+    '''
+    if checkpoint is None or not os.path.exists(checkpoint + INPUT_STATE_SUFFIX):
+        return None
+    with open(checkpoint + INPUT_STATE_SUFFIX, 'r') as f:
+        return json.load(f)
+
 class estimator_rui:
     '''
     A wrapper function which create data, model and loss according to input type
@@ -257,8 +280,12 @@ class estimator_rui:
             transformation_loss = tf.summary.scalar('losses/transformation_loss', losses[4])
             vis_loss = tf.summary.scalar('losses/vis_loss', losses[3])
 
-        image = tf.summary.image('image' , \
-                            data_dict['image'])
+        # Runs without color input do not decode the color image
+        for key in ['image','IR','depth']:
+            if key in data_dict:
+                image = tf.summary.image(key , \
+                                    data_dict[key])
+                break
 
         
         if self.opt.with_seg:
@@ -268,8 +295,8 @@ class estimator_rui:
             tf.summary.image('pred_label' , \
                                 pred)
 
+        random_landmark = tf.random_uniform([], 0, 27,dtype=tf.int32)
         if "points2D" in data_dict:
-            random_landmark = tf.random_uniform([], 0, 27,dtype=tf.int32)                 
             gt_landmark = tf.expand_dims(data_dict['points2D'][:,:,:,random_landmark],axis=3)#tf.expand_dims(tf.reduce_sum(data_dict['points2D'],3),axis=3)#tf.expand_dims(data_dict['points2D'][:,:,:,random_landmark],axis=3)#
             landmark_sum = tf.summary.image('gt_lm_img' , \
                                 gt_landmark)
@@ -297,7 +324,9 @@ class estimator_rui:
             input_ts_in = input_ts
 
         if network_type=="landmark":
-            num_out_channel = data_dict['points2D'].get_shape()[3].value
+            # From the record schema, the landmark labels are not decoded
+            # for every task (--nowith_hm)
+            num_out_channel = record_io.NUM_LANDMARKS
         else:
             num_out_channel = input_ts_in.get_shape()[3].value
 
@@ -312,7 +341,7 @@ class estimator_rui:
         return losses, output, data_dict,input_ts
         
 
-    def input_wrapper(self,dataset_dir,scope_name=None,num_epochs=None,is_training=True, is_reuse=False,with_loss=True,with_dataaug=False,test_input=False,num_out_channel=28):
+    def input_wrapper(self,dataset_dir,scope_name=None,num_epochs=None,is_training=True, is_reuse=False,with_loss=True,with_dataaug=False,test_input=False,num_out_channel=28,eval_input=False):
         '''
         A wrapper function which create a dataloader, construct a network model and compute loss
         '''
@@ -327,17 +356,59 @@ class estimator_rui:
         # Load training data
         if test_input:
             dataset = imageloader.inputs_test(self.opt.batch_size,num_epochs,with_dataaug)
+        elif eval_input:
+            # Ordered passes without augmentation, comparable between checkpoints
+            dataset = imageloader.inputs_eval(self.opt.batch_size,num_epochs)
+        elif self.opt.num_producers > 0:
+            # Decode and augmentation in worker processes, see shm_producer.py
+            dataset = producer_dataset(dataset_dir,
+                                       self.opt,
+                                       self.opt.batch_size,
+                                       num_epochs,
+                                       with_dataaug,
+                                       num_workers=self.opt.num_producers,
+                                       num_slots=self.opt.producer_slots)
         else:
             dataset = imageloader.inputs(self.opt.batch_size,num_epochs,with_dataaug)  # batch_size, num_epochs
 
         #Construct input accordingly
         #input_ts = self.construct_input(data_dict)
 
-        return dataset.make_one_shot_iterator()
+        iterator = dataset.make_one_shot_iterator()
+        if not test_input and not eval_input and getattr(self, 'train_loader', None) is None:
+            # The first (training) stream, its position is saved with the checkpoints
+            self.train_loader = imageloader
+            self.train_iterator = iterator
+        return iterator
     
+    def input_state(self, sess, global_step):
+        '''
+        Position of the training stream, None without one
+        '''
+        loader = getattr(self, 'train_loader', None)
+        if loader is None:
+            return None
+        records = self.opt.skip_records+int(sess.run(self.records_read))
+        return loader.input_state(global_step, records)
+
+    def count_records(self, data_dict):
+        '''
+        Count the records taken from the training stream. Every run that
+        fetches a batch adds its size, summary runs included, so the count
+        is the real stream position.
+        '''
+        self.records_read = tf.Variable(0, dtype=tf.int64, trainable=False, name='input_records',
+                                        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        key = sorted(data_dict.keys())[0]
+        count = tf.assign_add(self.records_read, tf.to_int64(tf.shape(data_dict[key])[0]))
+        with tf.control_dependencies([count]):
+            return dict([(key, tf.identity(value)) for key, value in data_dict.items()])
+
     def input_fn(self,dataset):
         with tf.device(None):
             data_dict = dataset.get_next()
+            if dataset is getattr(self, 'train_iterator', None):
+                data_dict = self.count_records(data_dict)
         return data_dict
 
 def write_params(opt):
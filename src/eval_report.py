@@ -7,7 +7,7 @@ import cv2
 import os,sys
 
 from model import *
-from data_loader_direct import DataLoader
+from data_loader_direct import DataLoader, define_loader_flags
 sys.path.insert(0,'/home/z003xr2y/data/Multi-task_CNN/src/py_img_seg_eval/')
 from eval_segm import *
 import xlsxwriter
@@ -18,18 +18,35 @@ img_height=480
 img_width=640
 os.environ["CUDA_VISIBLE_DEVICES"]="1"
 
+# Loader options, same meaning as in main.py
+flags = tf.app.flags
+flags.DEFINE_string("inputs", "IR", "all IR_depth depth_color IR_color IR color depth")
+flags.DEFINE_string("model", "single", "lastdecode sinlge")
+flags.DEFINE_boolean("evaluation", True, "Decode every feature")
+define_loader_flags(flags)
+opt = flags.FLAGS
+
 def evaluation(inputs,model,checkpoint_dir,with_seg,worksheet,row, method,thresh):
 
     tf.reset_default_graph()
     eps = 0.000001
-    #Initialize data loader
+    #Initialize data loader, the evaluation decodes every feature
+    opt.inputs = inputs
+    opt.model = model
+    opt.evaluation = True
     imageloader = DataLoader('/home/z003xr2y/data/data/tfrecords_hr_filldepth_val/',
                                 5,
                                 img_height, 
                                 img_width,
-                                'valid')
-    # Load training data
-    data_dict = imageloader.inputs(1,1)
+                                'valid',
+                                opt)
+    # One ordered pass without augmentation
+    data_dict = imageloader.inputs_eval(1,1).make_one_shot_iterator().get_next()
+    if opt.roi_crop:
+        # The window is centered on the ground-truth landmarks, the scores
+        # assume the board location is known and are marked in the report
+        print("--roi_crop: evaluation windows are centered on the ground-truth landmarks")
+        method = method+" (GT ROI)"
 
     #Concatenate color and depth for model input
     if inputs == "all":
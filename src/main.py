@@ -1,6 +1,6 @@
 import tensorflow as tf
 import numpy as np
-from data_loader_direct import DataLoader
+from data_loader_direct import DataLoader, define_loader_flags
 from my_losses import *
 from model import *
 import time
@@ -36,6 +36,7 @@ flags.DEFINE_integer("num_features", 32, "number of starting features")
 flags.DEFINE_integer("batch_size", 5, "The size of of a sample batch")
 flags.DEFINE_integer("img_height", 480, "Image height")
 flags.DEFINE_integer("img_width", 640, "Image width")
+define_loader_flags(flags)
 flags.DEFINE_integer("max_steps", 120, "Maximum number of training iterations")
 flags.DEFINE_integer("summary_freq", 100, "Logging every log_freq iterations")
 flags.DEFINE_integer("save_latest_freq", 1000, \
@@ -43,7 +44,6 @@ flags.DEFINE_integer("save_latest_freq", 1000, \
 flags.DEFINE_boolean("continue_train", False, "Continue training from previous checkpoint")
 flags.DEFINE_string("inputs", "all", "all IR_depth depth_color IR_color IR color depth")
 flags.DEFINE_string("model", "lastdecode", "lastdecode sinlge")
-flags.DEFINE_boolean("downsample", False, "Data augment")
 flags.DEFINE_boolean("data_aug", False, "Data augment")
 flags.DEFINE_boolean("with_seg", False, "with seg")
 flags.DEFINE_boolean("with_pose", False, "with pose estimation")
@@ -110,6 +110,31 @@ if not os.path.exists(opt.checkpoint_dir):
 #opt.checkpoint_dir = "/home/z003xr2y/data/Multi-task_CNN/src/checkpoints/IR_single/lr1_0.004_lr2_0.001_numEncode5_numFeatures32_thhm/"
 
 write_params(opt)
+
+#==========================
+#Resume the input stream where
+#the checkpoint left it
+#==========================
+if opt.continue_train:
+    if opt.init_checkpoint_file is None:
+        resume_checkpoint = tf.train.latest_checkpoint(opt.checkpoint_dir)
+    else:
+        resume_checkpoint = opt.init_checkpoint_file
+    input_state = load_input_state(resume_checkpoint)
+    stream = DataLoader(opt.dataset_dir, opt.batch_size, opt.img_height, opt.img_width, 'train', opt)
+    if input_state is None or not input_state.get('resumable', True):
+        if stream.resumable() and opt.skip_records == 0:
+            raise ValueError('%s has no resumable input state, the stream would start over '
+                             '(set --skip_records to start it elsewhere)' % resume_checkpoint)
+        print("No resumable input state saved with %s, the input stream starts over" % resume_checkpoint)
+    else:
+        if 'stream' in input_state and input_state['stream'] != stream.stream_mode():
+            raise ValueError('%s was saved by a %s stream, this run reads a %s stream' % (
+                resume_checkpoint, input_state['stream'], stream.stream_mode()))
+        opt.skip_records = input_state['records']
+        opt.shuffle_seed = input_state['shuffle_seed']
+        opt.subset_size = input_state['subset_size']
+        print("Resume input stream after %d records (seed %d)" % (opt.skip_records, opt.shuffle_seed))
 os.environ["CUDA_VISIBLE_DEVICES"]="2"
 #==========================
 #Define a estimator instance
@@ -142,11 +167,11 @@ elif opt.with_pose:
 coord_pair=1.5
 if opt.pretrain_pose:
 
-    input_ts,data_dict = m_trainer.input_wrapper(                                            
+    data_dict = m_trainer.input_fn(m_trainer.input_wrapper(
                                     opt.dataset_dir,
                                     scope_name,
                                     opt.max_steps,
-                                    with_dataaug=opt.data_aug)
+                                    with_dataaug=opt.data_aug))
 
     #==========================
     #Forward path for pose 
@@ -192,11 +217,14 @@ if opt.pretrain_pose:
 
 
 if opt.training and not opt.pretrain_pose:
-    losses, output, data_dict,_ = m_trainer.forward_wrapper(
+    data_dict = m_trainer.input_fn(m_trainer.input_wrapper(
                                             opt.dataset_dir,
                                             scope_name,
                                             opt.max_steps,
-                                            with_dataaug=opt.data_aug)
+                                            with_dataaug=opt.data_aug))
+    losses, output, data_dict,_ = m_trainer.forward_wrapper(
+                                            data_dict,
+                                            scope_name)
     losses = list(losses)
 
     #==========================
@@ -247,10 +275,15 @@ if opt.training and not opt.pretrain_pose:
 #==========================
 #import pdb;pdb.set_trace()
 if opt.evaluation_dir != "None":
-    losses_eval, output_eval, data_dict_eval,_ = m_trainer.forward_wrapper(
+    data_dict_eval = m_trainer.input_fn(m_trainer.input_wrapper(
                                                                         opt.evaluation_dir,
                                                                         scope_name,
                                                                         opt.max_steps,
+                                                                        is_reuse=opt.training,
+                                                                        eval_input=True))
+    losses_eval, output_eval, data_dict_eval,_ = m_trainer.forward_wrapper(
+                                                                        data_dict_eval,
+                                                                        scope_name,
                                                                         is_training=opt.training,
                                                                         is_reuse=opt.training)
     losses_eval = list(losses_eval)
@@ -291,10 +324,13 @@ else:
 if opt.domain_transfer_dir != "None" and opt.with_dom:
     
     #Forward mapping
-    _, output_fix, data_dict_fix,input_fix = m_trainer.forward_wrapper(
+    data_dict_fix = m_trainer.input_fn(m_trainer.input_wrapper(
                                                             opt.dataset_dir,
                                                             scope_name,
-                                                            opt.max_steps,
+                                                            opt.max_steps))
+    _, output_fix, data_dict_fix,input_fix = m_trainer.forward_wrapper(
+                                                            data_dict_fix,
+                                                            scope_name,
                                                             is_training=True,
                                                             is_reuse=False,
                                                             with_loss=False,
@@ -302,14 +338,17 @@ if opt.domain_transfer_dir != "None" and opt.with_dom:
 
 
     #Backward mapping
-    _, output_bw, data_dict_bw,input_bw = m_trainer.forward_wrapper(
+    data_dict_bw = m_trainer.input_fn(m_trainer.input_wrapper(
                                                             opt.domain_transfer_dir,
                                                             scope_name+"_bw",
                                                             opt.max_steps,
+                                                            test_input=True))
+    _, output_bw, data_dict_bw,input_bw = m_trainer.forward_wrapper(
+                                                            data_dict_bw,
+                                                            scope_name+"_bw",
                                                             is_training=True,
                                                             is_reuse=False,
                                                             with_loss=False,
-                                                            test_input=True,
                                                             network_type="G")
 
     m_domain_tans = domain_trans(m_trainer)
@@ -335,14 +374,17 @@ else:
 
 if opt.prediction:
     
-    _, output_dom, data_dict_dom = m_trainer.forward_wrapper(
+    data_dict_dom = m_trainer.input_fn(m_trainer.input_wrapper(
                                                             opt.domain_transfer_dir,
                                                             scope_name,
                                                             opt.max_steps,
+                                                            test_input=True))
+    _, output_dom, data_dict_dom,_ = m_trainer.forward_wrapper(
+                                                            data_dict_dom,
+                                                            scope_name,
                                                             is_training=False,
                                                             is_reuse=False,
-                                                            with_loss=False,
-                                                            test_input=True)
+                                                            with_loss=False)
 
 
 #==========================
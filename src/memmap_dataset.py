@@ -0,0 +1,189 @@
+from __future__ import division
+import tensorflow as tf
+import numpy as np
+import os
+import json
+import record_io
+
+#==================================
+# Memory-mapped NumPy dataset
+#==================================
+# One fixed-shape .npy array per modality, indexed by example, plus an
+# index.json describing them. Examples are read straight from the page
+# cache (no parsing, no copy of the other modalities), in any order.
+#
+#   color      uint8   [N,H,W,3]
+#   IR         uint8   [N,H,W,1]
+#   depth      uint16  [N,H,W,1]
+#   mask       uint8   [N,H,W,1]
+#   quaternion float32 [N,4]
+#   translation float32 [N,3]
+#   visibility float32 [N,28]
+#   matK       float32 [N,3,3]
+#   points2D   float32 [N,2,28]   landmark pixel coordinates
+#
+# Feature names are the record feature names, so the DataLoader maps them
+# to data_dict keys exactly as for tfrecords.
+
+INDEX_NAME = 'index.json'
+
+MEMMAP_DTYPES = {
+    'color': np.uint8,
+    'IR': np.uint8,
+    'depth': np.uint16,
+    'mask': np.uint8,
+    'quaternion': np.float32,
+    'translation': np.float32,
+    'visibility': np.float32,
+    'matK': np.float32,
+    'points2D': np.float32,
+}
+
+
+def feature_shapes(image_height, image_width):
+    '''
+    Per-example shape of every array
+    '''
+    H = image_height
+    W = image_width
+    return {
+        'color': [H, W, 3],
+        'IR': [H, W, 1],
+        'depth': [H, W, 1],
+        'mask': [H, W, 1],
+        'quaternion': [4],
+        'translation': [3],
+        'visibility': [record_io.NUM_LANDMARKS],
+        'matK': [3, 3],
+        'points2D': [2, record_io.NUM_LANDMARKS],
+    }
+
+
+def is_memmap_dataset(dataset_dir):
+    return os.path.exists(os.path.join(dataset_dir, INDEX_NAME))
+
+
+def record_arrays(serialized, image_height, image_width):
+    '''
+    Arrays of one serialized record (v1 or v2) in the memmap layout
+    '''
+    example = tf.train.Example.FromString(serialized)
+    version = record_io.example_version(example)
+    arrays = record_io.parse_example_numpy(serialized, version)
+    if version == record_io.RECORD_V1:
+        arrays['IR'] = arrays['IR'].reshape([image_height, image_width, 3])[:, :, 0]
+
+    shapes = feature_shapes(image_height, image_width)
+    out = {}
+    for key, dtype in MEMMAP_DTYPES.items():
+        value = arrays[key]
+        if np.issubdtype(dtype, np.integer) and not np.issubdtype(value.dtype, np.integer):
+            info = np.iinfo(dtype)
+            value = np.clip(np.round(value), info.min, info.max)
+        out[key] = value.astype(dtype).reshape(shapes[key])
+    return out
+
+
+def write_memmap(filenames, output_dir, image_height, image_width, compression='NONE', frames=None):
+    '''
+    Convert tfrecords files to a memmap dataset. frames (the frames.txt of
+    the records) is kept as the frames.txt of the examples.
+    '''
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    options = record_io.record_options(compression)
+
+    # The arrays are preallocated, count the records first
+    num_examples = 0
+    for filename in filenames:
+        for _ in tf.python_io.tf_record_iterator(filename, options):
+            num_examples += 1
+
+    shapes = feature_shapes(image_height, image_width)
+    arrays = {}
+    for key, dtype in MEMMAP_DTYPES.items():
+        arrays[key] = np.lib.format.open_memmap(os.path.join(output_dir, key+'.npy'),
+                                                mode='w+',
+                                                dtype=dtype,
+                                                shape=tuple([num_examples]+shapes[key]))
+
+    i = 0
+    for filename in filenames:
+        for serialized in tf.python_io.tf_record_iterator(filename, options):
+            for key, value in record_arrays(serialized, image_height, image_width).items():
+                arrays[key][i] = value
+            i += 1
+        print("Converted %s (%d/%d records)" % (filename, i, num_examples))
+
+    for array in arrays.values():
+        array.flush()
+    record_io.write_frames(output_dir, frames, num_examples)
+
+    index = {
+        'num_examples': num_examples,
+        'image_height': image_height,
+        'image_width': image_width,
+        'arrays': {key: {'file': key+'.npy',
+                         'dtype': np.dtype(dtype).name,
+                         'shape': shapes[key]} for key, dtype in MEMMAP_DTYPES.items()},
+    }
+    with open(os.path.join(output_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+class MemmapDataset(object):
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+        with open(os.path.join(dataset_dir, INDEX_NAME), 'r') as f:
+            self.index = json.load(f)
+        self.num_examples = self.index['num_examples']
+        self.arrays = {}
+
+    def array(self, key):
+        # Opened lazily, only the modalities a run reads get mapped
+        if key not in self.arrays:
+            self.arrays[key] = np.load(os.path.join(self.dataset_dir, self.index['arrays'][key]['file']),
+                                       mmap_mode='r')
+        return self.arrays[key]
+
+    def dtype(self, key):
+        return np.dtype(self.index['arrays'][key]['dtype'])
+
+    def shape(self, key):
+        return self.index['arrays'][key]['shape']
+
+    def read(self, index, keys):
+        '''
+        Copy example index of every array in keys
+        '''
+        return [np.array(self.array(key)[index]) for key in keys]
+
+    def tensors(self, index, keys):
+        '''
+        float32 tensors of example index (a scalar int64 tensor), one per key
+        '''
+        values = tf.py_func(lambda i: self.read(i, keys),
+                            [index],
+                            [tf.as_dtype(self.dtype(key)) for key in keys],
+                            stateful=False)
+        tensors = {}
+        for key, value in zip(keys, values):
+            value.set_shape(self.shape(key))
+            tensors[key] = tf.cast(value, tf.float32)
+        return tensors
+
+
+if __name__ == "__main__":
+    flags = tf.app.flags
+    flags.DEFINE_string("input_dir", "/home/z003xr2y/data/data/tfrecords_hr_filldepth_v2/", "Directory of tfrecords")
+    flags.DEFINE_string("output_dir", "/home/z003xr2y/data/data/memmap_hr_filldepth/", "Directory for the memmap dataset")
+    flags.DEFINE_integer("img_height", 480, "Image height")
+    flags.DEFINE_integer("img_width", 640, "Image width")
+    opt = flags.FLAGS
+
+    filenames = record_io.dataset_files(opt.input_dir)
+    _, compression = record_io.detect_record_format(opt.input_dir, filenames)
+    index = write_memmap(filenames, opt.output_dir, opt.img_height, opt.img_width, compression,
+                         record_io.read_frames(opt.input_dir))
+    print("Wrote %d examples to %s" % (index['num_examples'], opt.output_dir))
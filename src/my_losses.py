@@ -129,13 +129,15 @@ def compute_loss(output,data_dict,FLAGS):
     quaternion_weight = 5000
     scale_weight = 0.1
 
-    label_batch = data_dict['label']
-    landmark = data_dict['points2D']
-    visibility = data_dict['visibility']
+    # The loader only decodes what the active losses use (see
+    # DataLoader.required_features), so some keys may be missing
+    label_batch = data_dict.get('label')
+    landmark = data_dict.get('points2D')
+    visibility = data_dict.get('visibility')
 
-    quaternion = data_dict['quaternion']
-    translation = data_dict['translation']
-    depth = data_dict["depth"]
+    quaternion = data_dict.get('quaternion')
+    translation = data_dict.get('translation')
+    depth = data_dict.get("depth")
 
     
     if FLAGS.with_seg:
@@ -228,7 +230,10 @@ def compute_loss(output,data_dict,FLAGS):
             elif FLAGS.with_coordconv:
                 lm_coord = tf.reshape(output[1],[-1,2,28])
 
-                B,H,W,D = landmark.get_shape().as_list()
+                # Coordinates only: no full-resolution heatmap is needed
+                H = FLAGS.img_height
+                W = FLAGS.img_width
+                D = data_dict['pixel_coords'].get_shape().as_list()[2]
 
                 gt_coord = data_dict['pixel_coords']
                 gt_coord.set_shape([FLAGS.batch_size,2,D])                
@@ -0,0 +1,62 @@
+from __future__ import division
+import numpy as np
+
+#==================================
+# Frame pairs for pose and homography training
+#==================================
+# pose_estimate, H_estimate and DH_estimate relate batch items 0 and 1 and
+# skip the step when fewer than 6 landmarks are usable in both. The pair
+# stream yields anchor, partner, anchor, partner, ... where the partner is
+# drawn from the anchor's sequence among the frames sharing at least
+# min_shared visible landmarks with it, so every even-sized batch starts
+# with a usable pair.
+
+
+def pair_order(records, visibility, sequence, num_epochs, seed, min_shared=6, skip=0):
+    '''
+    Ids of num_epochs epochs of pairs over records (None: forever). Every
+    record is an anchor once per epoch, in a permutation drawn from
+    (seed, epoch); anchors without a partner are left out. The first skip
+    ids of the stream are dropped without reading anything, whole epochs
+    without drawing them.
+    Args:
+        records: Record ids to draw anchors and partners from
+        visibility: [N,28] visibility of all records
+        sequence: [N] sequence id of all records
+    '''
+    # Whole pairs only, the stream stays aligned with the batches
+    skip -= skip % 2
+    records = np.asarray(records)
+    visible = (visibility[records] > 0).astype(np.int32)
+    # Positions in records of the frames of every sequence
+    groups = {}
+    for position, seq in enumerate(sequence[records]):
+        groups.setdefault(seq, []).append(position)
+    groups = dict([(seq, np.array(positions)) for seq, positions in groups.items()])
+
+    def partners_of(anchor):
+        group = groups[sequence[records[anchor]]]
+        shared = visible[group].dot(visible[anchor])
+        return group[(shared >= min_shared) & (group != anchor)]
+
+    # Which anchors have a partner does not depend on the epoch, every epoch
+    # has the same length and the skip starts in its own epoch
+    num_pairs = sum([1 for anchor in range(len(records)) if len(partners_of(anchor)) > 0])
+    if num_pairs == 0:
+        raise ValueError('no frame pair shares %d visible landmarks' % min_shared)
+    epoch = skip // (2*num_pairs)
+    skip = skip % (2*num_pairs)
+    while num_epochs is None or epoch < num_epochs:
+        rng = np.random.RandomState([seed, epoch])
+        for anchor in rng.permutation(len(records)):
+            partners = partners_of(anchor)
+            if len(partners) == 0:
+                continue
+            # Drawn for skipped pairs too, the rest of the epoch is unchanged
+            partner = partners[rng.randint(len(partners))]
+            if skip > 0:
+                skip -= 2
+                continue
+            yield records[anchor]
+            yield records[partner]
+        epoch += 1
@@ -0,0 +1,163 @@
+from __future__ import division
+import tensorflow as tf
+import numpy as np
+import os
+import struct
+import threading
+
+#==================================
+# Offset index of uncompressed tfrecords
+#==================================
+# A tfrecords file is a sequence of
+#   uint64 length | uint32 crc of length | data[length] | uint32 crc of data
+# so every record can be read with one seek once its offset is known. The
+# index (file, offset, length per record, ~20 bytes each) replaces the
+# sequential reader: an epoch is a permutation of the index, skip(n) is
+# arithmetic on it and a subset is a sample of it.
+
+INDEX_NAME = 'record_index.npz'
+
+HEADER_BYTES = 12
+FOOTER_BYTES = 4
+
+
+def scan_file(filename):
+    '''
+    (offsets, lengths) of the data of every record of one file
+    '''
+    offsets = []
+    lengths = []
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        position = 0
+        while position < size:
+            f.seek(position)
+            header = f.read(HEADER_BYTES)
+            if len(header) < HEADER_BYTES:
+                raise ValueError('%s: truncated record at byte %d' % (filename, position))
+            length = struct.unpack('<Q', header[:8])[0]
+            offsets.append(position+HEADER_BYTES)
+            lengths.append(length)
+            position += HEADER_BYTES+length+FOOTER_BYTES
+    return offsets, lengths
+
+
+def build_index(filenames):
+    '''
+    Index arrays of a list of uncompressed tfrecords files
+    '''
+    file_ids = []
+    offsets = []
+    lengths = []
+    for i, filename in enumerate(filenames):
+        file_offsets, file_lengths = scan_file(filename)
+        file_ids += [i]*len(file_offsets)
+        offsets += file_offsets
+        lengths += file_lengths
+    return {'files': np.array([os.path.basename(filename) for filename in filenames]),
+            'sizes': np.array([os.path.getsize(filename) for filename in filenames], dtype=np.int64),
+            'file_ids': np.array(file_ids, dtype=np.int32),
+            'offsets': np.array(offsets, dtype=np.int64),
+            'lengths': np.array(lengths, dtype=np.int64)}
+
+
+def load_or_build_index(dataset_dir, filenames):
+    '''
+    The index stored in dataset_dir, rebuilt if the files changed
+    '''
+    path = os.path.join(dataset_dir, INDEX_NAME)
+    names = [os.path.basename(filename) for filename in filenames]
+    sizes = [os.path.getsize(filename) for filename in filenames]
+    if os.path.exists(path):
+        index = dict(np.load(path))
+        if list(index['files']) == names and list(index['sizes']) == sizes:
+            return index
+    print("Building the record index of %s" % dataset_dir)
+    index = build_index(filenames)
+    try:
+        np.savez(path, **index)
+    except IOError:
+        # Read-only dataset, the index is rebuilt next time
+        pass
+    return index
+
+
+def subset_records(num_records, size, seed):
+    '''
+    Sorted ids of a fixed random subset of size records (all if size is 0)
+    '''
+    if size <= 0 or size >= num_records:
+        return np.arange(num_records)
+    return np.sort(np.random.RandomState(seed).choice(num_records, size, replace=False))
+
+
+def record_order(records, num_epochs, seed, skip=0, shuffle=True, weights=None):
+    '''
+    Ids of num_epochs epochs over records (None: forever), every epoch a new
+    permutation drawn from (seed, epoch). The first skip ids of the stream
+    are dropped without reading anything, so a stream restarted with the
+    same seed and skip continues exactly where it stopped. With weights
+    (probabilities of records) an epoch is len(records) weighted draws.
+    '''
+    if len(records) == 0:
+        raise ValueError('no records to read, --min_visible or --subset_size filtered out every record')
+    epoch = skip // len(records)
+    position = skip % len(records)
+    while num_epochs is None or epoch < num_epochs:
+        if shuffle and weights is not None:
+            permutation = np.random.RandomState([seed, epoch]).choice(records, len(records), p=weights)
+        elif shuffle:
+            permutation = np.random.RandomState([seed, epoch]).permutation(records)
+        else:
+            permutation = records
+        for record in permutation[position:]:
+            yield record
+        position = 0
+        epoch += 1
+
+
+class RecordIndex(object):
+    def __init__(self, dataset_dir, filenames):
+        self.dataset_dir = dataset_dir
+        self.filenames = filenames
+        index = load_or_build_index(dataset_dir, filenames)
+        self.file_ids = index['file_ids']
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.num_records = len(self.offsets)
+        # One handle per file and reader thread
+        self.local = threading.local()
+
+    def read(self, record):
+        '''
+        Serialized record number record
+        '''
+        if not hasattr(self.local, 'handles'):
+            self.local.handles = {}
+        file_id = self.file_ids[record]
+        if file_id not in self.local.handles:
+            self.local.handles[file_id] = open(self.filenames[file_id], 'rb')
+        f = self.local.handles[file_id]
+        f.seek(self.offsets[record])
+        return f.read(self.lengths[record])
+
+    def dataset(self, num_epochs, seed, records=None, skip=0, shuffle=True, num_parallel_calls=8, order=None):
+        '''
+        tf.data.Dataset of serialized records in the order of record_order()
+        over records (default: all), or of the ids order() generates
+        '''
+        if records is None:
+            records = np.arange(self.num_records)
+        if order is None:
+            order = lambda: record_order(records, num_epochs, seed, skip, shuffle)
+
+        def read(record):
+            value = tf.py_func(self.read, [record], tf.string, stateful=False)
+            value.set_shape([])
+            return value
+
+        dataset = tf.data.Dataset.from_generator(
+            order,
+            tf.int64,
+            tf.TensorShape([]))
+        return dataset.map(read, num_parallel_calls=num_parallel_calls)
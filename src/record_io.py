@@ -0,0 +1,382 @@
+from __future__ import division
+import tensorflow as tf
+import numpy as np
+import os, glob
+import json
+
+
+#==================================
+# TFRecord schema versions
+#==================================
+# v1: color float64, IR float32 3-channel, depth float32, dense 28-channel
+#     float32 landmark heatmaps (~40MB per record at 480x640)
+# v2: color/IR uint8, depth uint16, landmark coordinates only; the heatmaps
+#     are rendered in the input pipeline from 'points2D' and 'visibility'
+RECORD_V1 = 1
+RECORD_V2 = 2
+
+NUM_LANDMARKS = 28
+
+# Frame (capture prefix) of every record, one per line in record order
+FRAMES_NAME = 'frames.txt'
+
+V1_KEYS = ['color', 'IR', 'depth', 'mask', 'quaternion', 'translation',
+           'landmark_heatmap', 'visibility', 'matK', 'H', 'points2D']
+V2_KEYS = ['color', 'IR', 'depth', 'mask', 'quaternion', 'translation',
+           'visibility', 'matK', 'H', 'points2D']
+
+# Raw dtype of every byte feature, per schema version
+V1_DTYPES = {
+    'color': np.float64,
+    'IR': np.float32,
+    'depth': np.float32,
+    'mask': np.uint8,
+    'quaternion': np.float64,
+    'translation': np.float64,
+    'landmark_heatmap': np.float32,
+    'visibility': np.float32,
+    'matK': np.float64,
+    'H': np.float64,
+    'points2D': np.float64,
+}
+V2_DTYPES = {
+    'color': np.uint8,
+    'IR': np.uint8,
+    'depth': np.uint16,
+    'mask': np.uint8,
+    'quaternion': np.float64,
+    'translation': np.float64,
+    'visibility': np.float32,
+    'matK': np.float32,
+    'H': np.float64,
+    'points2D': np.float32,
+}
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def record_dtypes(version):
+    '''
+    Raw numpy dtype of every byte feature of a record version
+    '''
+    if version == RECORD_V2:
+        return V2_DTYPES
+    return V1_DTYPES
+
+
+def record_features(version, keys=None):
+    '''
+    Feature spec for tf.parse_single_example / tf.parse_example.
+    Args:
+        version: RECORD_V1 or RECORD_V2
+        keys: Optional subset of feature names to parse
+    '''
+    if keys is None:
+        keys = V2_KEYS if version == RECORD_V2 else V1_KEYS
+    return {key: tf.FixedLenFeature([], tf.string) for key in keys}
+
+
+def encode_example_v2(color, IR, depth, mask, quaternion, translation,
+                      visibility, matK, H, points2D):
+    '''
+    Serialize one frame in the v2 schema.
+    Args:
+        color: HxWx3 image in [0,255]
+        IR: HxW or HxWx1 image in [0,255]
+        depth: HxW or HxWx1 depth map
+        mask: HxW or HxWx1 uint8 segmentation mask
+        quaternion, translation, H: ground truth pose and homography
+        visibility: 28 landmark visibility flags
+        matK: 3x3 camera intrinsics
+        points2D: 2x28 landmark pixel coordinates
+    Returns:
+        A tf.train.Example
+    '''
+    def to_bytes(value, dtype):
+        value = np.asarray(value)
+        if np.issubdtype(dtype, np.integer):
+            # Saturate instead of wrapping around, also for wider integers
+            info = np.iinfo(dtype)
+            if not np.issubdtype(value.dtype, np.integer):
+                value = np.round(value)
+            value = np.clip(value, info.min, info.max)
+        return value.astype(dtype).tobytes()
+
+    features = {
+        'version': _int64_feature(RECORD_V2),
+        'color': _bytes_feature(to_bytes(color, np.uint8)),
+        'IR': _bytes_feature(to_bytes(IR, np.uint8)),
+        'depth': _bytes_feature(to_bytes(depth, np.uint16)),
+        'mask': _bytes_feature(to_bytes(mask, np.uint8)),
+        'quaternion': _bytes_feature(to_bytes(quaternion, np.float64)),
+        'translation': _bytes_feature(to_bytes(translation, np.float64)),
+        'visibility': _bytes_feature(to_bytes(visibility, np.float32)),
+        'matK': _bytes_feature(to_bytes(matK, np.float32)),
+        'H': _bytes_feature(to_bytes(H, np.float64)),
+        'points2D': _bytes_feature(to_bytes(points2D, np.float32)),
+    }
+    return tf.train.Example(features=tf.train.Features(feature=features))
+
+
+def parse_example_numpy(serialized, version=None):
+    '''
+    Decode a serialized record into numpy arrays (flat, raw dtype) without
+    building a graph. Used by the offline tools.
+    '''
+    example = tf.train.Example.FromString(serialized)
+    feature = example.features.feature
+    if version is None:
+        version = example_version(example)
+    dtypes = record_dtypes(version)
+    arrays = {}
+    for key, dtype in dtypes.items():
+        if key in feature:
+            arrays[key] = np.frombuffer(feature[key].bytes_list.value[0], dtype=dtype)
+    return arrays
+
+
+def example_version(example):
+    '''
+    Schema version of a parsed tf.train.Example. v1 records carry no tag.
+    '''
+    feature = example.features.feature
+    if 'version' in feature:
+        return int(feature['version'].int64_list.value[0])
+    return RECORD_V1
+
+
+def example_v1_to_v2(serialized, image_height, image_width):
+    '''
+    Convert one serialized v1 record to a v2 tf.train.Example.
+    Only channel 0 of the v1 IR image is kept (the loader never uses the
+    others) and the dense heatmaps are dropped.
+    '''
+    arrays = parse_example_numpy(serialized, RECORD_V1)
+    IR = arrays['IR'].reshape([image_height, image_width, 3])[:, :, 0]
+    return encode_example_v2(arrays['color'],
+                             IR,
+                             arrays['depth'],
+                             arrays['mask'],
+                             arrays['quaternion'],
+                             arrays['translation'],
+                             arrays['visibility'],
+                             arrays['matK'],
+                             arrays['H'],
+                             arrays['points2D'])
+
+
+def estimate_heatmap_sigma(serialized, image_height, image_width):
+    '''
+    Estimate the gaussian sigma (pixels) of the dense heatmaps in a v1
+    record from their second moments, so the rendered v2 heatmaps can
+    match the old targets (see --hm_sigma).
+    '''
+    arrays = parse_example_numpy(serialized, RECORD_V1)
+    heatmap = arrays['landmark_heatmap'].reshape([image_height, image_width, NUM_LANDMARKS]).astype(np.float64)
+    ys, xs = np.mgrid[0:image_height, 0:image_width]
+    sigmas = []
+    for c in range(NUM_LANDMARKS):
+        hm = heatmap[:, :, c]
+        total = hm.sum()
+        if total <= 0:
+            continue
+        mx = (hm*xs).sum()/total
+        my = (hm*ys).sum()/total
+        var = (hm*((xs-mx)**2+(ys-my)**2)).sum()/total/2.0
+        sigmas.append(np.sqrt(var))
+    if len(sigmas) == 0:
+        return None
+    return float(np.median(sigmas))
+
+
+#==================================
+# Compression
+#==================================
+# ZLIB/GZIP shrink v1 records a lot (the heatmap channels are mostly zero)
+# at the cost of inflating every record on the input threads
+COMPRESSION_TYPES = ['NONE', 'ZLIB', 'GZIP']
+
+
+def record_options(compression):
+    '''
+    TFRecordOptions for a compression name, None when uncompressed
+    '''
+    if compression not in COMPRESSION_TYPES:
+        raise ValueError('Unknown compression %s' % compression)
+    if compression == 'NONE':
+        return None
+    return tf.python_io.TFRecordOptions(getattr(tf.python_io.TFRecordCompressionType, compression))
+
+
+def dataset_compression_type(compression):
+    '''
+    compression_type argument of tf.data.TFRecordDataset
+    '''
+    if compression == 'NONE':
+        return ''
+    return compression
+
+
+def detect_compression(filename):
+    '''
+    Compression of a record file, found by reading its first record with
+    every codec
+    '''
+    for compression in COMPRESSION_TYPES:
+        try:
+            for _ in tf.python_io.tf_record_iterator(filename, record_options(compression)):
+                break
+            return compression
+        except tf.errors.DataLossError:
+            continue
+    raise ValueError('%s is not a tfrecords file' % filename)
+
+
+def detect_record_version(filenames, compression='NONE'):
+    '''
+    Schema version of a dataset, read from the first record of the first file.
+    '''
+    if len(filenames) == 0:
+        raise ValueError('No tfrecords files found')
+    for serialized in tf.python_io.tf_record_iterator(filenames[0], record_options(compression)):
+        return example_version(tf.train.Example.FromString(serialized))
+    return RECORD_V1
+
+
+def detect_record_format(dataset_dir, filenames):
+    '''
+    (version, compression) of a dataset, from its manifest if there is one
+    '''
+    if len(filenames) == 0:
+        raise ValueError('No tfrecords files found')
+    manifest = load_manifest(dataset_dir)
+    if manifest is not None:
+        return manifest['version'], manifest.get('compression', 'NONE')
+    compression = detect_compression(filenames[0])
+    return detect_record_version(filenames, compression), compression
+
+
+#==================================
+# Sharded datasets
+#==================================
+MANIFEST_NAME = 'manifest.json'
+
+
+def read_frames(dataset_dir):
+    '''
+    Frame prefix of every record from the frames.txt of dataset_dir, in
+    record order, None without it
+    '''
+    path = os.path.join(dataset_dir, FRAMES_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return [line.rstrip('\r\n') for line in f if line.strip() != '']
+
+
+def write_frames(output_dir, frames, num_records):
+    '''
+    Write frames.txt for num_records records, unless frames is None or
+    does not list one frame per record
+    '''
+    if frames is None:
+        return
+    if len(frames) != num_records:
+        print("%d frames for %d records, %s not written" % (len(frames), num_records, FRAMES_NAME))
+        return
+    with open(os.path.join(output_dir, FRAMES_NAME), 'w') as f:
+        for prefix in frames:
+            f.write(prefix+'\n')
+
+
+def shard_name(index, num_shards):
+    return 'shard-%05d-of-%05d.tfrecords' % (index, num_shards)
+
+
+def write_shards(records, output_dir, num_shards, version, compression='NONE', frames=None):
+    '''
+    Write serialized records to num_shards size-balanced shards and a
+    manifest. Every record goes to the shard with the fewest bytes so far,
+    so the shards stay within one record size of each other.
+    Args:
+        records: Iterable of serialized tf.train.Example strings
+        output_dir: Directory for the shards and manifest.json
+        num_shards: Number of shards
+        version: Schema version of the records
+        compression: One of COMPRESSION_TYPES
+        frames: Frame of every record (frames.txt of the input), written
+                to frames.txt in the order of the shards
+    Returns:
+        The manifest dict
+    '''
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    names = [shard_name(i, num_shards) for i in range(num_shards)]
+    options = record_options(compression)
+    writers = [tf.python_io.TFRecordWriter(os.path.join(output_dir, name), options) for name in names]
+    sizes = np.zeros(num_shards, dtype=np.int64)
+    counts = np.zeros(num_shards, dtype=np.int64)
+    # Input record ids of every shard
+    shard_records = [[] for _ in range(num_shards)]
+
+    for i, serialized in enumerate(records):
+        shard = int(np.argmin(sizes))
+        writers[shard].write(serialized)
+        sizes[shard] += len(serialized)
+        counts[shard] += 1
+        shard_records[shard].append(i)
+
+    for writer in writers:
+        writer.close()
+    if frames is not None and len(frames) == int(counts.sum()):
+        frames = [frames[i] for ids in shard_records for i in ids]
+    write_frames(output_dir, frames, int(counts.sum()))
+
+    return write_manifest(output_dir, version, compression,
+                          [{'file': names[i],
+                            'num_records': int(counts[i]),
+                            'bytes': int(sizes[i])} for i in range(num_shards)])
+
+
+def write_manifest(output_dir, version, compression, shards):
+    '''
+    Write manifest.json for shards, a list of {file, num_records, bytes}
+    '''
+    manifest = {
+        'version': version,
+        'compression': compression,
+        'num_records': sum([shard['num_records'] for shard in shards]),
+        'shards': shards,
+    }
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_manifest(dataset_dir):
+    '''
+    manifest.json of a sharded dataset, None for a plain tfrecords folder
+    '''
+    path = os.path.join(dataset_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def dataset_files(dataset_dir):
+    '''
+    Record files of a dataset: the shards listed in the manifest, otherwise
+    every *.tfrecords file of the folder
+    '''
+    manifest = load_manifest(dataset_dir)
+    if manifest is not None:
+        return [os.path.join(dataset_dir, shard['file']) for shard in manifest['shards']]
+    return sorted(glob.glob(os.path.join(dataset_dir, '*.tfrecords')))
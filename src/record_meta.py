@@ -0,0 +1,240 @@
+from __future__ import division
+import tensorflow as tf
+import numpy as np
+import os
+import multiprocessing
+import record_io
+import memmap_dataset
+
+#==================================
+# Per-record metadata
+#==================================
+# Small arrays about every record of a dataset, indexed like the record
+# index (records of dataset_files() in order), so samplers can filter and
+# weight the whole dataset without decoding it:
+#   visibility   float32 [N,28]  landmark visibility flags
+#   num_visible  int32   [N]     visible landmarks
+#   bbox         float32 [N,4]   x0, y0, x1, y1 of the visible landmarks, -1 if none
+#   board_depth  float32 [N]     mean valid depth under the mask, 0 if none
+#   sequence     int32   [N]     capture sequence (folder) of the record
+# The sequences come from the frames.txt written by convert_raw.py; without
+# it every record is in sequence 0 and has_sequences is False, the samplers
+# that need sequences refuse the dataset. The arrays are computed once, one
+# process per record file, and stored in record_meta.npz.
+
+META_NAME = 'record_meta.npz'
+FRAMES_NAME = record_io.FRAMES_NAME
+
+
+def frame_names(dataset_dir, num_records):
+    '''
+    Frame prefix of every record from frames.txt, None without it
+    '''
+    frames = record_io.read_frames(dataset_dir)
+    if frames is not None and len(frames) != num_records:
+        print("%s lists %d frames for %d records, ignoring it" % (os.path.join(dataset_dir, FRAMES_NAME), len(frames), num_records))
+        return None
+    return frames
+
+
+def sequence_ids(dataset_dir, num_records):
+    '''
+    (sequence id of every record, sequence names). Without frames.txt
+    every record is in sequence 0 and the names are None.
+    '''
+    frames = frame_names(dataset_dir, num_records)
+    if frames is None:
+        return np.zeros(num_records, dtype=np.int32), None
+    names, ids = np.unique([os.path.dirname(frame) for frame in frames], return_inverse=True)
+    return ids.astype(np.int32), list(names)
+
+
+def frame_meta(visibility, points2D, depth, mask):
+    '''
+    Metadata of one frame from its flat arrays
+    '''
+    visible = visibility > 0
+    points2D = points2D.reshape([2, record_io.NUM_LANDMARKS])
+    if visible.any():
+        x = points2D[0, visible]
+        y = points2D[1, visible]
+        bbox = [x.min(), y.min(), x.max(), y.max()]
+    else:
+        bbox = [-1, -1, -1, -1]
+    board = (mask.reshape([-1]) > 0) & (depth.reshape([-1]) > 0)
+    board_depth = depth.reshape([-1])[board].mean() if board.any() else 0
+    return {'visibility': visibility.astype(np.float32),
+            'num_visible': int(visible.sum()),
+            'bbox': np.array(bbox, dtype=np.float32),
+            'board_depth': float(board_depth)}
+
+
+def stack_meta(frames):
+    '''
+    Metadata arrays of a list of frame_meta() outputs
+    '''
+    return {'visibility': np.array([f['visibility'] for f in frames], dtype=np.float32).reshape([-1, record_io.NUM_LANDMARKS]),
+            'num_visible': np.array([f['num_visible'] for f in frames], dtype=np.int32),
+            'bbox': np.array([f['bbox'] for f in frames], dtype=np.float32).reshape([-1, 4]),
+            'board_depth': np.array([f['board_depth'] for f in frames], dtype=np.float32)}
+
+
+def scan_file(args):
+    '''
+    frame_meta() of every record of one file
+    '''
+    filename, compression = args
+    frames = []
+    for serialized in tf.python_io.tf_record_iterator(filename, record_io.record_options(compression)):
+        arrays = record_io.parse_example_numpy(serialized)
+        frames.append(frame_meta(arrays['visibility'], arrays['points2D'], arrays['depth'], arrays['mask']))
+    return frames
+
+
+def imap_jobs(function, jobs, num_workers):
+    '''
+    function() of every job in order, from num_workers processes. Daemonic
+    processes (the input producers of shm_producer.py) cannot have
+    children and run the jobs themselves.
+    '''
+    if num_workers <= 1 or multiprocessing.current_process().daemon:
+        for job in jobs:
+            yield function(job)
+        return
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        # imap keeps the job order
+        for result in pool.imap(function, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def scan_records(filenames, compression='NONE', num_workers=8):
+    '''
+    Metadata arrays of every record of filenames, one process per file
+    '''
+    frames = []
+    for filename, file_frames in zip(filenames, imap_jobs(scan_file, [(filename, compression) for filename in filenames], num_workers)):
+        frames += file_frames
+        print("Scanned %s (%d records)" % (filename, len(frames)))
+    return stack_meta(frames)
+
+
+def scan_memmap(dataset_dir, chunk=256):
+    '''
+    Metadata arrays of a memmap dataset, from its arrays in chunks
+    '''
+    source = memmap_dataset.MemmapDataset(dataset_dir)
+    frames = []
+    for start in range(0, source.num_examples, chunk):
+        batch = dict([(key, np.array(source.array(key)[start:start+chunk]))
+                      for key in ['visibility', 'points2D', 'depth', 'mask']])
+        for i in range(len(batch['visibility'])):
+            frames.append(frame_meta(batch['visibility'][i], batch['points2D'][i], batch['depth'][i], batch['mask'][i]))
+    return stack_meta(frames)
+
+
+def load_or_build_meta(dataset_dir, names, sizes, build):
+    '''
+    The metadata stored in dataset_dir, rebuilt with build() if the files
+    (names, sizes) changed
+    '''
+    path = os.path.join(dataset_dir, META_NAME)
+    if os.path.exists(path):
+        meta = dict(np.load(path))
+        if list(meta['files']) == names and list(meta['sizes']) == sizes and 'num_visible' in meta:
+            # frames.txt may have been written after the metadata
+            return with_sequences(dataset_dir, meta)
+    print("Building the record metadata of %s" % dataset_dir)
+    meta = build()
+    meta['files'] = np.array(names)
+    meta['sizes'] = np.array(sizes, dtype=np.int64)
+    meta = with_sequences(dataset_dir, meta)
+    try:
+        np.savez(path, **meta)
+    except IOError:
+        # Read-only dataset, the metadata is rebuilt next time
+        pass
+    return meta
+
+
+def with_sequences(dataset_dir, meta):
+    '''
+    meta with the sequence of every record from the current frames.txt
+    and has_sequences, False without it
+    '''
+    sequence, sequence_names = sequence_ids(dataset_dir, len(meta['visibility']))
+    meta['sequence'] = sequence
+    meta['has_sequences'] = np.array(sequence_names is not None)
+    return meta
+
+
+def require_sequences(meta, option):
+    '''
+    Raise if the records of meta have no sequences, option needs them
+    '''
+    if not meta['has_sequences']:
+        raise ValueError('%s needs the sequence of every record from %s (written by convert_raw.py '
+                         'and carried by shard_records.py and memmap_dataset.py), the dataset has none' % (option, FRAMES_NAME))
+
+
+def dataset_key(dataset_dir):
+    '''
+    (file names, sizes) a sidecar of dataset_dir is valid for
+    '''
+    if memmap_dataset.is_memmap_dataset(dataset_dir):
+        return [memmap_dataset.INDEX_NAME], [memmap_dataset.MemmapDataset(dataset_dir).num_examples]
+    filenames = record_io.dataset_files(dataset_dir)
+    return ([os.path.basename(filename) for filename in filenames],
+            [os.path.getsize(filename) for filename in filenames])
+
+
+def dataset_meta(dataset_dir, num_workers=8):
+    '''
+    Metadata of a tfrecords or memmap dataset
+    '''
+    names, sizes = dataset_key(dataset_dir)
+    if memmap_dataset.is_memmap_dataset(dataset_dir):
+        return load_or_build_meta(dataset_dir, names, sizes, lambda: scan_memmap(dataset_dir))
+    filenames = record_io.dataset_files(dataset_dir)
+    _, compression = record_io.detect_record_format(dataset_dir, filenames)
+    return load_or_build_meta(dataset_dir, names, sizes, lambda: scan_records(filenames, compression, num_workers))
+
+
+def record_weights(meta, records, mode):
+    '''
+    Sampling probabilities of records
+    Args:
+        mode: none (uniform, returns None), visible (proportional to the
+              visible landmarks) or sequence (every sequence equally often)
+    '''
+    if mode == "none":
+        return None
+    if mode == "visible":
+        weights = meta['num_visible'][records].astype(np.float64)
+    elif mode == "sequence":
+        # Without sequences this would be uniform sampling
+        require_sequences(meta, '--sample_weights=sequence')
+        sequence = meta['sequence'][records]
+        _, inverse, counts = np.unique(sequence, return_inverse=True, return_counts=True)
+        weights = 1.0/counts[inverse]
+    else:
+        raise ValueError('unknown sample weighting %s' % mode)
+    if weights.sum() <= 0:
+        # No record has any visible landmark
+        print("All %s weights are 0, sampling uniformly" % mode)
+        return None
+    return weights/weights.sum()
+
+
+if __name__ == "__main__":
+    flags = tf.app.flags
+    flags.DEFINE_string("dataset_dir", "/home/z003xr2y/data/data/tfrecords_hr_filldepth_v2/", "tfrecords or memmap dataset")
+    flags.DEFINE_integer("num_workers", 8, "Number of scanning processes")
+    opt = flags.FLAGS
+
+    meta = dataset_meta(opt.dataset_dir, opt.num_workers)
+    print("%d records, %d with fewer than 5 visible landmarks, %d sequences" % (
+        len(meta['num_visible']), int((meta['num_visible'] < 5).sum()), len(np.unique(meta['sequence']))))
@@ -0,0 +1,34 @@
+import tensorflow as tf
+import record_io
+
+#==================================
+# Repack a folder of tfrecords into
+# size-balanced shards with a manifest
+#==================================
+
+flags = tf.app.flags
+flags.DEFINE_string("input_dir", "/home/z003xr2y/data/data/tfrecords_hr_filldepth_v2/", "Directory of tfrecords")
+flags.DEFINE_string("output_dir", "/home/z003xr2y/data/data/tfrecords_hr_filldepth_v2_sharded/", "Directory for the shards")
+flags.DEFINE_integer("num_shards", 64, "Number of shards")
+flags.DEFINE_string("compression", "NONE", "NONE ZLIB GZIP")
+opt = flags.FLAGS
+
+
+def read_records(filenames, compression):
+    options = record_io.record_options(compression)
+    for filename in filenames:
+        for serialized in tf.python_io.tf_record_iterator(filename, options):
+            yield serialized
+        print("Read %s" % filename)
+
+
+if __name__ == "__main__":
+    filenames = record_io.dataset_files(opt.input_dir)
+    version, compression = record_io.detect_record_format(opt.input_dir, filenames)
+    manifest = record_io.write_shards(read_records(filenames, compression),
+                                      opt.output_dir,
+                                      opt.num_shards,
+                                      version,
+                                      opt.compression,
+                                      record_io.read_frames(opt.input_dir))
+    print("Wrote %d records to %d shards in %s" % (manifest['num_records'], opt.num_shards, opt.output_dir))
@@ -0,0 +1,162 @@
+from __future__ import division
+import tensorflow as tf
+import numpy as np
+import multiprocessing
+import argparse
+import os
+
+#==================================
+# Multi-process input producer
+#==================================
+# Every worker process builds its own DataLoader.inputs pipeline (decode,
+# render, data_augmentation2, batch) on its share of the dataset and copies
+# the finished batches into a ring of shared-memory slots. The training
+# process copies every batch out of its slot (no pickling), hands the slot
+# back to the worker and yields the copy through a tf.data.Dataset.
+#
+#   free[worker]: slots the worker may fill
+#   full:         (worker, slot) ready to be consumed, (worker, None) at the end
+
+
+def flag_values(opt):
+    '''
+    Picklable copy of the flags for the worker processes
+    '''
+    if hasattr(opt, 'flag_values_dict'):
+        return opt.flag_values_dict()
+    return dict(vars(opt))
+
+
+def batch_layout(dataset, batch_size):
+    '''
+    {key: (dtype, shape, offset)} of a batch in a slot, and the slot size
+    '''
+    layout = {}
+    offset = 0
+    for key in sorted(dataset.output_shapes.keys()):
+        shape = [batch_size] + dataset.output_shapes[key].as_list()[1:]
+        if None in shape:
+            raise ValueError('%s has no static shape %s, it cannot be put in shared memory' % (key, shape))
+        dtype = np.dtype(dataset.output_types[key].as_numpy_dtype)
+        layout[key] = (dtype.str, shape, offset)
+        # Keep every array 64-byte aligned
+        offset += int(np.prod(shape))*dtype.itemsize
+        offset = (offset+63)//64*64
+    return layout, offset
+
+
+def slot_views(buffer, slot, slot_bytes, layout):
+    '''
+    numpy arrays of one slot, backed by the shared buffer
+    '''
+    views = {}
+    for key, (dtype, shape, offset) in layout.items():
+        dtype = np.dtype(dtype)
+        views[key] = np.frombuffer(buffer,
+                                   dtype=dtype,
+                                   count=int(np.prod(shape)),
+                                   offset=slot*slot_bytes+offset).reshape(shape)
+    return views
+
+
+def producer_worker(worker, num_workers, dataset_dir, values, batch_size, num_epochs, with_aug,
+                    layout, slot_bytes, buffer, free, full):
+    # The producers only need the CPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    from data_loader_direct import DataLoader
+
+    opt = argparse.Namespace(**values)
+    # Resumed streams are split evenly between the workers
+    opt.skip_records = opt.skip_records//num_workers
+    # A forked worker inherits the half-built training graph, start a new one
+    with tf.Graph().as_default():
+        loader = DataLoader(dataset_dir, batch_size, opt.img_height, opt.img_width, 'train', opt)
+        loader.worker_shard = (worker, num_workers)
+        next_batch = loader.inputs(batch_size, num_epochs, with_aug).make_one_shot_iterator().get_next()
+        produce(next_batch, batch_size, layout, slot_bytes, buffer, free, full, worker)
+    full.put((worker, None))
+
+
+def produce(next_batch, batch_size, layout, slot_bytes, buffer, free, full, worker):
+    config = tf.ConfigProto(device_count={'GPU': 0})
+    with tf.Session(config=config) as sess:
+        try:
+            while True:
+                batch = sess.run(next_batch)
+                if len(batch[sorted(layout.keys())[0]]) != batch_size:
+                    # Last partial batch of the stream
+                    continue
+                slot = free.get()
+                views = slot_views(buffer, slot, slot_bytes, layout)
+                for key in layout:
+                    views[key][...] = batch[key]
+                full.put((worker, slot))
+        except tf.errors.OutOfRangeError:
+            pass
+
+
+def producer_dataset(dataset_dir, opt, batch_size, num_epochs=None, with_aug=False,
+                     num_workers=4, num_slots=2):
+    '''
+    Batches of DataLoader.inputs produced by num_workers processes.
+    Args:
+        dataset_dir, batch_size, num_epochs, with_aug: as for DataLoader.inputs
+        opt: Flags, the workers get a copy
+        num_workers: Number of producer processes
+        num_slots: Shared-memory batches per worker
+    Returns:
+        A tf.data.Dataset with the element structure of DataLoader.inputs
+    '''
+    from data_loader_direct import DataLoader
+
+    values = flag_values(opt)
+    if values['cache_dir'] != "None":
+        # Every worker reads its own share of the files: their entries would
+        # each get a key of their own and evict one another
+        print("Input producers decode uncached, --cache_dir is not used")
+        values['cache_dir'] = "None"
+
+    # Shapes and dtypes of a batch, from a graph that is never run
+    with tf.Graph().as_default():
+        loader = DataLoader(dataset_dir, batch_size, opt.img_height, opt.img_width, 'train', argparse.Namespace(**values))
+        # Sidecars are built here, the forked workers only load them
+        loader.prepare_sidecars()
+        spec = loader.inputs(batch_size, num_epochs, with_aug)
+        layout, slot_bytes = batch_layout(spec, batch_size)
+        output_types = spec.output_types
+        output_shapes = {key: tf.TensorShape(shape) for key, (_, shape, _) in layout.items()}
+    print("Input producers: %d workers x %d slots of %.1f MB" % (num_workers, num_slots, slot_bytes/1e6))
+
+    # Fork while no session exists yet. spawn (Windows) re-imports the main
+    # script, which needs an `if __name__ == "__main__":` guard there.
+    ctx = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+    buffers = []
+    frees = []
+    full = ctx.Queue()
+    for worker in range(num_workers):
+        buffer = ctx.RawArray('b', slot_bytes*num_slots)
+        free = ctx.Queue()
+        for slot in range(num_slots):
+            free.put(slot)
+        process = ctx.Process(target=producer_worker,
+                              args=(worker, num_workers, dataset_dir, values, batch_size, num_epochs, with_aug,
+                                    layout, slot_bytes, buffer, free, full))
+        process.daemon = True
+        process.start()
+        buffers.append(buffer)
+        frees.append(free)
+
+    def generator():
+        running = num_workers
+        while running > 0:
+            worker, slot = full.get()
+            if slot is None:
+                running -= 1
+                continue
+            # Copied out of the slot: tf.data may keep the arrays it is
+            # given alive (prefetch) after the slot is handed back
+            batch = dict([(key, np.array(view)) for key, view in slot_views(buffers[worker], slot, slot_bytes, layout).items()])
+            frees[worker].put(slot)
+            yield batch
+
+    return tf.data.Dataset.from_generator(generator, output_types, output_shapes)
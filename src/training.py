@@ -150,7 +150,7 @@ def training(opt,m_trainer,losses,losses_eval,
                     #     print(results["gt3d"][2])
                     # print(results["pred3d"][0,:,1])
                 if step % opt.save_latest_freq == 0:
-                    save(sess, opt.checkpoint_dir, gs,saver)
+                    save(sess, opt.checkpoint_dir, gs,saver,m_trainer.input_state(sess,gs))
                 step += 1
                 
         except tf.errors.OutOfRangeError:
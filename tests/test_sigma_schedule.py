@@ -0,0 +1,38 @@
+import argparse
+import os
+import sys
+
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from data_loader_direct import DataLoader
+
+
+def make_loader(worker_shard=None):
+    opt = argparse.Namespace(hm_sigma=2.0, hm_sigma_start=8.0, change_gauss=10,
+                             record_height=0, record_width=0)
+    loader = DataLoader('.', 4, 48, 64, 'train', opt)
+    loader.worker_shard = worker_shard
+    return loader
+
+
+def sigmas(loader, batches):
+    with tf.Graph().as_default():
+        batch = tf.placeholder(tf.int64, [])
+        sigma = loader.heatmap_sigma(loader.schedule_step(batch))
+        with tf.Session() as sess:
+            return [float(sess.run(sigma, {batch: b})) for b in batches]
+
+
+@pytest.mark.parametrize("num_workers", [2, 3])
+def test_producers_follow_the_single_stream_schedule(num_workers):
+    num_batches = 24
+    single = sigmas(make_loader(), range(num_batches))
+    # The trainer takes one batch of every worker in turn
+    merged = [None]*num_batches
+    for worker in range(num_workers):
+        local = range(num_batches//num_workers)
+        for b, sigma in zip(local, sigmas(make_loader((worker, num_workers)), local)):
+            merged[b*num_workers+worker] = sigma
+    assert merged == pytest.approx(single)